@@ -15,8 +15,8 @@ import subprocess
 import threading
 import mimetypes
 import difflib
-import tempfile
 import venv
+import itertools
 
 from dotenv import load_dotenv
 from typing import Any, Dict, List, Optional, Tuple, Union, AsyncIterable
@@ -87,11 +87,17 @@ code_editor_memory: List[str] = []
 code_editor_files: set = set()
 running_processes: Dict[str, subprocess.Popen] = {}
 
-# Token usage tracking
+# Token usage tracking (running totals per agent role)
 main_model_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
 tool_checker_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
 code_editor_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
 code_execution_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
+role_token_totals: Dict[str, Dict[str, int]] = {
+    'main_model': main_model_tokens,
+    'tool_checker': tool_checker_tokens,
+    'code_editor': code_editor_tokens,
+    'code_execution': code_execution_tokens,
+}
 
 # Voice commands
 VOICE_COMMANDS = {
@@ -100,6 +106,17 @@ VOICE_COMMANDS = {
     "reset conversation": "reset_conversation"
 }
 
+# Code execution worker pool (see execute_code). Library only: nothing in this script calls
+# execute_code yet, the pool starts with the first call and main() shuts it down on the way out.
+CODE_WORKER_POOL_SIZE = 2
+CODE_WORKER_MAX_RUNS = 50  # Recycle a worker after this many snippets
+CODE_WORKER_MAX_MEMORY_MB = 512  # Recycle a worker once its peak memory goes above this
+CODE_WORKER_WAIT_TIMEOUT = 60  # Seconds to wait for an idle worker when all of them are busy
+code_worker_pool: Optional[asyncio.Queue] = None
+code_worker_pool_lock = asyncio.Lock()
+code_worker_count = 0  # Live workers, idle in the pool or running a snippet
+code_worker_tasks: set = set()  # Worker replacements in flight, referenced until they finish
+
 # Automode settings
 automode = False
 MAX_CONTINUATION_ITERATIONS = 25
@@ -206,34 +223,43 @@ def setup_virtual_environment() -> Tuple[str, str]:
         logging.error(f"Error setting up virtual environment: {str(e)}")
         raise
 
+def reset_token_usage():
+    """Zero the running token totals in place."""
+    for tokens in role_token_totals.values():
+        for key in tokens:
+            tokens[key] = 0
+
 def reset_conversation():
     """Reset the conversation history and related data."""
-    global conversation_history, main_model_tokens, tool_checker_tokens
-    global code_editor_tokens, code_execution_tokens, file_contents, code_editor_files
+    global conversation_history, file_contents, code_editor_files
     conversation_history.clear()
     file_contents.clear()
     code_editor_files.clear()
-    main_model_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
-    tool_checker_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
-    code_editor_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
-    code_execution_tokens = {'input': 0, 'output': 0, 'cache_write': 0, 'cache_read': 0}
+    reset_token_usage()
     console.print(Panel("Conversation and context have been reset.", style="bold green"))
 
-def save_chat() -> str:
-    """Save the conversation history to a Markdown file."""
-    now = datetime.datetime.now()
-    filename = f"Chat_{now.strftime('%Y%m%d_%H%M%S')}.md"
-    formatted_chat = "# Chat Log\n\n"
-    for message in conversation_history:
+def iter_chat_markdown(messages: List[Dict[str, Any]]):
+    """Yield the Markdown chat log one message at a time."""
+    yield "# Chat Log\n\n"
+    for message in messages:
         role = message.get('role', '')
         content = message.get('content', '')
         if role == 'user':
-            formatted_chat += f"## User\n\n{content}\n\n"
+            yield f"## User\n\n{content}\n\n"
         elif role == 'assistant':
-            formatted_chat += f"## Assistant\n\n{content}\n\n"
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(formatted_chat)
-    return filename
+            yield f"## Assistant\n\n{content}\n\n"
+
+def save_chat() -> str:
+    """Save the conversation history to a Markdown file without overwriting earlier logs."""
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    for attempt in itertools.count(1):
+        filename = f"Chat_{stamp}{'' if attempt == 1 else f'_{attempt}'}.md"
+        try:
+            with open(filename, 'x', encoding='utf-8') as f:
+                f.writelines(iter_chat_markdown(conversation_history))
+            return filename
+        except FileExistsError:
+            continue
 
 def validate_command_whitelist(command: str) -> bool:
     """Validate shell commands against a whitelist."""
@@ -244,49 +270,244 @@ def sanitize_input(input_str: str) -> str:
     """Sanitize user input to prevent injection attacks."""
     return input_str.replace(';', '').replace('&', '').replace('|', '').strip()
 
-async def execute_code(code: str, timeout: int = 10) -> Tuple[str, str]:
-    """Execute code in an isolated environment with sandboxing."""
-    venv_path, activate_script = setup_virtual_environment()
-    if not isinstance(code, str):
-        raise ValueError("Code must be a string.")
-
-    # Create a temporary file for the code
-    with tempfile.NamedTemporaryFile(mode='w', suffix='.py', delete=False) as tmp_file:
-        tmp_file.write(code)
-        code_file = tmp_file.name
-
-    # Prepare the command to run the code
-    if sys.platform == "win32":
-        command = f'"{activate_script}" && python "{code_file}"'
-    else:
-        command = f'source "{activate_script}" && python "{code_file}"'
-
-    # Execute the command with restricted permissions
+# Runs inside each worker. Requests and responses are JSON lines on private copies of the
+# original stdin and stdout, while fd 0 is pointed at os.devnull and fds 1 and 2 at temp files
+# around each snippet, so that input() can't read the protocol and output from C extensions and
+# child processes is captured too. Every snippet gets a fresh namespace, and the environment,
+# working directory, sys.path, sys.argv and modules it imported are put back afterwards, as if
+# it had run in its own process (modules the worker had already imported are shared).
+CODE_WORKER_SCRIPT = r"""
+import json, os, sys, tempfile, traceback
+protocol_in = os.fdopen(os.dup(0), 'r', encoding='utf-8')
+protocol_out = os.fdopen(os.dup(1), 'w', encoding='utf-8')
+devnull = os.open(os.devnull, os.O_RDWR)
+os.dup2(devnull, 0)
+os.dup2(devnull, 1)
+sys.stdin = open(os.devnull, 'r')
+base_cwd = os.getcwd()
+base_environ = dict(os.environ)
+base_path = list(sys.path)
+base_argv = list(sys.argv)
+base_modules = set(sys.modules)
+
+def restore_state():
+    os.chdir(base_cwd)
+    os.environ.clear()
+    os.environ.update(base_environ)
+    sys.path[:] = base_path
+    sys.argv[:] = base_argv
+    for name in set(sys.modules) - base_modules:
+        del sys.modules[name]
+
+def peak_memory_mb():
     try:
-        process = await asyncio.create_subprocess_shell(
-            command,
+        import resource
+    except ImportError:
+        return 0.0
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+for line in protocol_in:
+    code = json.loads(line)['code']
+    with tempfile.TemporaryFile() as out_file, tempfile.TemporaryFile() as err_file:
+        sys.stdout.flush(); sys.stderr.flush()
+        saved_err = os.dup(2)
+        os.dup2(out_file.fileno(), 1)
+        os.dup2(err_file.fileno(), 2)
+        return_code = 0
+        try:
+            exec(compile(code, '<execution>', 'exec'), {'__name__': '__main__'})
+        except SystemExit as e:
+            return_code = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except BaseException:
+            traceback.print_exc()
+            return_code = 1
+        finally:
+            sys.stdout.flush(); sys.stderr.flush()
+            os.dup2(devnull, 1)
+            os.dup2(saved_err, 2)
+            os.close(saved_err)
+            restore_state()
+        out_file.seek(0); err_file.seek(0)
+        response = {
+            'stdout': out_file.read().decode('utf-8', 'replace'),
+            'stderr': err_file.read().decode('utf-8', 'replace'),
+            'return_code': return_code,
+            'memory_mb': peak_memory_mb(),
+        }
+    protocol_out.write(json.dumps(response) + '\n')
+    protocol_out.flush()
+"""
+
+class CodeExecutionWorker:
+    """A warm Python interpreter in code_execution_env that runs snippets sent over a pipe."""
+
+    def __init__(self, process: asyncio.subprocess.Process):
+        self.process = process
+        self.runs = 0
+        self.memory_mb = 0.0
+
+    @classmethod
+    async def start(cls) -> "CodeExecutionWorker":
+        """Start a worker using the code_execution_env interpreter."""
+        venv_path, _ = setup_virtual_environment()
+        if sys.platform == "win32":
+            python_path = os.path.join(venv_path, "Scripts", "python.exe")
+        else:
+            python_path = os.path.join(venv_path, "bin", "python")
+        process = await asyncio.create_subprocess_exec(
+            python_path, "-u", "-c", CODE_WORKER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE,
             stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.DEVNULL,
+            limit=64 * 1024 * 1024,
             preexec_fn=lambda: os.setgid(1000) if sys.platform != "win32" else None
         )
+        return cls(process)
+
+    @property
+    def pid(self) -> int:
+        return self.process.pid
+
+    def needs_recycle(self) -> bool:
+        """Check whether the worker has died or reached its run or memory limit."""
+        return (
+            self.process.returncode is not None
+            or self.runs >= CODE_WORKER_MAX_RUNS
+            or self.memory_mb >= CODE_WORKER_MAX_MEMORY_MB
+        )
+
+    async def run(self, code: str, timeout: int) -> Dict[str, Any]:
+        """Run a snippet and return its stdout, stderr and return code."""
+        self.runs += 1
+        self.process.stdin.write((json.dumps({"code": code}) + "\n").encode())
+        await self.process.stdin.drain()
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout=timeout)
+        if not line:
+            raise RuntimeError("Code execution worker exited unexpectedly.")
+        result = json.loads(line)
+        self.memory_mb = result.get("memory_mb", 0.0)
+        return result
+
+    async def stop(self):
+        """Terminate the worker process."""
+        if self.process.returncode is None:
+            self.process.kill()
+            await self.process.wait()
+
+async def get_code_worker_pool() -> asyncio.Queue:
+    """Return the pool of warm code execution workers, starting it on first use."""
+    global code_worker_pool, code_worker_count
+    async with code_worker_pool_lock:
+        if code_worker_pool is None:
+            workers = await asyncio.gather(*(CodeExecutionWorker.start() for _ in range(CODE_WORKER_POOL_SIZE)), return_exceptions=True)
+            errors = [worker for worker in workers if isinstance(worker, BaseException)]
+            if errors:
+                for worker in workers:
+                    if not isinstance(worker, BaseException):
+                        await worker.stop()
+                raise errors[0]
+            pool = asyncio.Queue()
+            for worker in workers:
+                pool.put_nowait(worker)
+            code_worker_count = len(workers)
+            code_worker_pool = pool
+    return code_worker_pool
+
+async def acquire_code_worker() -> CodeExecutionWorker:
+    """Take an idle worker, starting one if failed restarts left the pool short."""
+    global code_worker_count
+    pool = await get_code_worker_pool()
+    if pool.empty() and code_worker_count < CODE_WORKER_POOL_SIZE:
+        code_worker_count += 1
         try:
-            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout=timeout)
-            stdout = stdout.decode()
-            stderr = stderr.decode()
-            return_code = process.returncode
-        except asyncio.TimeoutError:
-            process.kill()
-            await process.communicate()
-            stdout, stderr = '', 'Execution timed out.'
-            return_code = 'Timed out'
-        execution_result = f"Stdout:\n{stdout}\n\nStderr:\n{stderr}\n\nReturn Code: {return_code}"
-        return code_file, execution_result
+            return await CodeExecutionWorker.start()
+        except BaseException:
+            code_worker_count -= 1
+            raise
+    return await asyncio.wait_for(pool.get(), timeout=CODE_WORKER_WAIT_TIMEOUT)
+
+def release_code_worker(worker: CodeExecutionWorker):
+    """Return a worker to the pool, or replace it in the background if it needs recycling."""
+    if worker.needs_recycle():
+        task = asyncio.create_task(replace_code_worker(worker))
+        code_worker_tasks.add(task)
+        task.add_done_callback(code_worker_tasks.discard)
+    elif code_worker_pool is not None:
+        code_worker_pool.put_nowait(worker)
+    else:
+        # The pool was shut down while the worker was busy
+        task = asyncio.create_task(worker.stop())
+        code_worker_tasks.add(task)
+        task.add_done_callback(code_worker_tasks.discard)
+
+async def replace_code_worker(worker: CodeExecutionWorker):
+    """Stop a worker and put a fresh one in the pool."""
+    global code_worker_count
+    await worker.stop()
+    code_worker_count -= 1
+    if code_worker_pool is None:
+        return
+    try:
+        new_worker = await CodeExecutionWorker.start()
+    except Exception as e:
+        # The pool stays short, acquire_code_worker starts a worker when one is needed
+        logging.error(f"Error starting code execution worker: {str(e)}")
+        return
+    if code_worker_pool is None:
+        await new_worker.stop()
+        return
+    code_worker_count += 1
+    code_worker_pool.put_nowait(new_worker)
+
+async def shutdown_code_workers():
+    """Stop every idle worker in the pool and wait for pending replacements."""
+    global code_worker_pool, code_worker_count
+    if code_worker_pool is None:
+        return
+    pool = code_worker_pool
+    code_worker_pool = None
+    if code_worker_tasks:
+        await asyncio.gather(*code_worker_tasks, return_exceptions=True)
+    while not pool.empty():
+        await pool.get_nowait().stop()
+    code_worker_count = 0
+
+async def execute_code(code: str, timeout: int = 10) -> Tuple[str, str]:
+    """Execute code in an isolated environment using a warm worker from the pool.
+
+    Returns (worker_id, result). worker_id ("worker-<pid>") takes the place of the temporary file
+    path returned before the pool existed, snippets are no longer written to a file.
+    """
+    if not isinstance(code, str):
+        raise ValueError("Code must be a string.")
+
+    try:
+        worker = await acquire_code_worker()
+    except asyncio.TimeoutError:
+        return '', "Error executing code: no code execution worker became available."
     except Exception as e:
         logging.error(f"Error executing code: {str(e)}")
         return '', f"Error executing code: {str(e)}"
+
+    worker_id = f"worker-{worker.pid}"
+    try:
+        result = await worker.run(code, timeout)
+        stdout, stderr, return_code = result['stdout'], result['stderr'], result['return_code']
+    except asyncio.TimeoutError:
+        # The worker is still busy with the snippet, so it can't be reused
+        worker.runs = CODE_WORKER_MAX_RUNS
+        stdout, stderr = '', 'Execution timed out.'
+        return_code = 'Timed out'
+    except Exception as e:
+        worker.runs = CODE_WORKER_MAX_RUNS
+        logging.error(f"Error executing code: {str(e)}")
+        return worker_id, f"Error executing code: {str(e)}"
     finally:
-        # Clean up the temporary file
-        os.remove(code_file)
+        release_code_worker(worker)
+
+    execution_result = f"Stdout:\n{stdout}\n\nStderr:\n{stderr}\n\nReturn Code: {return_code}"
+    return worker_id, execution_result
 
 def run_shell_command(command: str) -> Dict[str, Any]:
     """Run a shell command from a whitelist."""
@@ -349,47 +570,51 @@ async def main():
 
     voice_mode = False
 
-    while True:
-        if voice_mode:
-            user_input = await voice_input()
-            if user_input is None:
-                voice_mode = False
-                cleanup_speech_recognition()
-                continue
-            stay_in_voice_mode, command_result = process_voice_command(user_input)
-            if not stay_in_voice_mode:
-                voice_mode = False
-                cleanup_speech_recognition()
-                if command_result:
+    try:
+        while True:
+            if voice_mode:
+                user_input = await voice_input()
+                if user_input is None:
+                    voice_mode = False
+                    cleanup_speech_recognition()
+                    continue
+                stay_in_voice_mode, command_result = process_voice_command(user_input)
+                if not stay_in_voice_mode:
+                    voice_mode = False
+                    cleanup_speech_recognition()
+                    if command_result:
+                        console.print(Panel(command_result, style="cyan"))
+                    continue
+                elif command_result:
                     console.print(Panel(command_result, style="cyan"))
+                    continue
+            else:
+                user_input = await get_user_input()
+
+            if user_input.lower() == 'exit':
+                console.print(Panel("Goodbye!", style="bold green"))
+                break
+            elif user_input.lower() == 'reset':
+                reset_conversation()
                 continue
-            elif command_result:
-                console.print(Panel(command_result, style="cyan"))
+            elif user_input.lower() == 'voice':
+                voice_mode = True
+                initialize_speech_recognition()
+                console.print(Panel("Voice mode activated.", style="bold green"))
                 continue
-        else:
-            user_input = await get_user_input()
-
-        if user_input.lower() == 'exit':
-            console.print(Panel("Goodbye!", style="bold green"))
-            break
-        elif user_input.lower() == 'reset':
-            reset_conversation()
-            continue
-        elif user_input.lower() == 'voice':
-            voice_mode = True
-            initialize_speech_recognition()
-            console.print(Panel("Voice mode activated.", style="bold green"))
-            continue
-        elif user_input.lower() == 'save chat':
-            filename = save_chat()
-            console.print(Panel(f"Chat saved to {filename}", style="bold green"))
-            continue
-        elif user_input.lower().startswith('automode'):
-            # Handle automode logic with proper error handling
-            pass
-        else:
-            # Process the user input and interact with the AI assistant
-            pass
+            elif user_input.lower() == 'save chat':
+                filename = save_chat()
+                console.print(Panel(f"Chat saved to {filename}", style="bold green"))
+                continue
+            elif user_input.lower().startswith('automode'):
+                # Handle automode logic with proper error handling
+                pass
+            else:
+                # Process the user input and interact with the AI assistant
+                pass
+    finally:
+        # Also runs on EOF and Ctrl+C, so no worker interpreter outlives the assistant
+        await shutdown_code_workers()
 
 if __name__ == "__main__":
     try:
@@ -0,0 +1,70 @@
+"""Compares read_multiple_files with a serial read loop.
+
+Usage: python benchmarks/bench_read_multiple_files.py [--files 500] [--latency-ms 2] [--runs 3]
+
+--latency-ms adds a delay to every file open, which approximates a network filesystem.
+"""
+import argparse
+import builtins
+import importlib.util
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_engineer():
+    # ollama-eng.py isn't importable by name because of the dash in it
+    os.environ.setdefault("TAVILY_API_KEY", "benchmark")
+    spec = importlib.util.spec_from_file_location("ollama_eng", os.path.join(ROOT, "ollama-eng.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["ollama_eng"] = module
+    spec.loader.exec_module(module)
+    return module
+
+
+def best_of(runs, engineer, read, paths):
+    timings = []
+    for _ in range(runs):
+        engineer.file_contents.clear()
+        started = time.perf_counter()
+        read(paths)
+        timings.append(time.perf_counter() - started)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    engineer = load_engineer()
+    if args.latency_ms:
+        def delayed_open(*open_args, **open_kwargs):
+            time.sleep(args.latency_ms / 1000)
+            return builtins.open(*open_args, **open_kwargs)
+        # Module globals shadow builtins, so only the engineer's own reads are delayed
+        engineer.open = delayed_open
+
+    with tempfile.TemporaryDirectory() as directory:
+        paths = []
+        for i in range(args.files):
+            path = os.path.join(directory, f"module_{i}.py")
+            with builtins.open(path, "w") as f:
+                f.write(f"def function_{i}():\n    return {i}\n" * 20)
+            paths.append(path)
+
+        serial = best_of(args.runs, engineer, lambda p: "\n".join(engineer.read_context_files_safely(p)), paths)
+        pooled = best_of(args.runs, engineer, engineer.read_multiple_files, paths)
+
+    print(f"{args.files} files, {args.latency_ms} ms added latency, best of {args.runs}:")
+    print(f"  serial loop: {serial:.1f} ms")
+    print(f"  read_multiple_files ({engineer.FILE_READ_WORKERS} workers): {pooled:.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
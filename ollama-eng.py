@@ -1,23 +1,50 @@
 import os
 from dotenv import load_dotenv
 import json
-from tavily import TavilyClient
 import re
 import ollama
 import asyncio
 import difflib
+import codecs
 import time
 import logging
+import hashlib
+import ast
+import bisect
+import itertools
+import mmap
+import fnmatch
+from abc import ABC, abstractmethod
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+from collections.abc import MutableMapping
+import sqlite3
+import threading
+import queue
 from typing import Optional, Dict, Any
 from rich.console import Console
 from rich.panel import Panel
 from rich.syntax import Syntax
 from rich.markdown import Markdown
-import asyncio
+from rich.live import Live
 import aiohttp
+import httpx
+import random
 from prompt_toolkit import PromptSession
 from prompt_toolkit.styles import Style
 
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # Optional, the file watcher falls back to polling without it
+    Observer = None
+    FileSystemEventHandler = object
+
+try:
+    import anthropic
+except ImportError:  # Optional, only needed by the anthropic model provider
+    anthropic = None
+
 async def get_user_input(prompt="You: "):
     style = Style.from_dict({
         'prompt': 'cyan bold',
@@ -29,36 +56,420 @@ import datetime
 # Load environment variables from .env file
 load_dotenv()
 
-# Initialize the Ollama client
-client = ollama.AsyncClient()
-
-# Initialize the Tavily client
+# Tavily settings (searches go through a shared aiohttp session, see tavily_search)
 tavily_api_key = os.getenv("TAVILY_API_KEY")
 if not tavily_api_key:
     raise ValueError("TAVILY_API_KEY not found in environment variables")
-tavily = TavilyClient(api_key=tavily_api_key)
+TAVILY_API_URL = os.getenv("TAVILY_API_URL", "https://api.tavily.com")
 
 console = Console()
 
 
+class FileContextStore(MutableMapping):
+    # file_contents, keyed by path. For every entry backed by a file on disk it also keeps the
+    # (mtime, size, hash) the file had when the entry was stored, so revalidate() can detect
+    # outside changes with a stat and re-read only those files. Identical contents share one
+    # string object, which also lets the prompt segment cache skip rehashing them. Wraps a dict
+    # rather than subclassing it so update(), setdefault() and friends all go through __setitem__.
+    def __init__(self):
+        self.contents = {}
+        self.file_stats = {}
+        self.blobs = {}
+        self.blob_refs = {}
+        self.lock = threading.Lock()
+
+    def __getitem__(self, path):
+        return self.contents[path]
+
+    def __iter__(self):
+        return iter(self.contents)
+
+    def __len__(self):
+        return len(self.contents)
+
+    def __contains__(self, path):
+        return path in self.contents
+
+    def __setitem__(self, path, content):
+        # Content we wrote ourselves, the stat is taken now
+        try:
+            stat = os.stat(path)
+        except OSError:
+            stat = None  # Line ranges and other entries that aren't a file on disk
+        self.store(path, content, stat)
+
+    def store(self, path, content, stat):
+        # stat is the os.fstat of the handle the content was read from, taken before reading it,
+        # so a write that lands during or after the read always shows up as a change
+        digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+        with self.lock:
+            if path in self.contents:
+                self.release(path)
+            content = self.blobs.setdefault(digest, content)
+            self.blob_refs[digest] = self.blob_refs.get(digest, 0) + 1
+            self.contents[path] = content
+            self.file_stats[path] = (stat.st_mtime_ns if stat else None, stat.st_size if stat else None, digest)
+
+    def __delitem__(self, path):
+        with self.lock:
+            del self.contents[path]
+            self.release(path)
+
+    def clear(self):
+        with self.lock:
+            self.contents.clear()
+            self.file_stats.clear()
+            self.blobs.clear()
+            self.blob_refs.clear()
+
+    def release(self, path):
+        _, _, digest = self.file_stats.pop(path)
+        self.blob_refs[digest] -= 1
+        if not self.blob_refs[digest]:
+            del self.blob_refs[digest]
+            del self.blobs[digest]
+
+    def refresh(self, path):
+        # Re-reads a tracked file if its stat changed. Returns a unified diff of the change,
+        # or None if the file is unchanged or isn't a file-backed entry.
+        stats = self.file_stats.get(path)
+        if not stats or stats[0] is None:
+            return None
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self.pop(path, None)
+            partial_file_views.discard(path)
+            return f"--- a/{path}\n+++ /dev/null\n(file deleted)\n"
+        if (stat.st_mtime_ns, stat.st_size) == stats[:2]:
+            return None
+        old_content = self.get(path, "")
+        load_file_into_context(path)
+        new_content = self.get(path, "")
+        return "".join(difflib.unified_diff(
+            old_content.splitlines(keepends=True),
+            new_content.splitlines(keepends=True),
+            fromfile=f"a/{path}",
+            tofile=f"b/{path}",
+            n=1
+        ))
+
+    def revalidate(self):
+        # Returns {path: diff} for the files that were reloaded or dropped because they changed on disk
+        changed = {}
+        for path in list(self.file_stats):
+            try:
+                diff = self.refresh(path)
+            except Exception as e:
+                logging.error(f"Error reloading {path}: {str(e)}")
+                continue
+            if diff is not None:
+                changed[path] = diff
+        return changed
+
+
+class ContextFileEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            if event.event_type == "created":
+                self.watcher.watch_directory(event.src_path)
+            return
+        self.watcher.queue(event.src_path)
+        if getattr(event, "dest_path", None):
+            self.watcher.queue(event.dest_path)
+
+
+class FileWatcher:
+    # Watches the project root with inotify (through watchdog when installed) and queues the paths
+    # that changed in file_watcher_events, bursts of events debounced into one batch. The batches
+    # are applied to file_contents by build_file_segments on the event loop thread, which also
+    # stats every file in context, and that stat check is all the polling fallback does.
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.timer = None
+        self.observer = None
+        self.handler = ContextFileEventHandler(self)
+
+    @property
+    def mode(self):
+        return "inotify" if self.observer is not None else "polling"
+
+    def start(self):
+        if Observer is not None:
+            try:
+                self.observer = Observer()
+                for directory, subdirectories, _ in os.walk(self.root):
+                    subdirectories[:] = [d for d in subdirectories if d not in WATCH_IGNORED_DIRS]
+                    self.observer.schedule(self.handler, directory, recursive=False)
+                self.observer.start()
+                return
+            except Exception as e:
+                logging.error(f"Falling back to polling for file changes: {str(e)}")
+                self.observer = None
+
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()
+
+    def is_ignored(self, path):
+        relative = os.path.relpath(os.path.abspath(path), self.root)
+        return any(part in WATCH_IGNORED_DIRS for part in relative.split(os.sep))
+
+    def watch_directory(self, path):
+        if self.observer is not None and not self.is_ignored(path):
+            self.observer.schedule(self.handler, path, recursive=False)
+
+    def queue(self, path):
+        if self.is_ignored(path):
+            return
+        with self.lock:
+            self.pending.add(os.path.abspath(path))
+            if self.timer is not None:
+                self.timer.cancel()
+            self.timer = threading.Timer(WATCH_DEBOUNCE_SECONDS, self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def flush(self):
+        # Runs on the timer thread, so it only hands the paths over
+        with self.lock:
+            pending, self.pending = self.pending, set()
+            self.timer = None
+        mark_code_index_dirty(pending)
+        mark_symbol_index_dirty(pending)
+        file_watcher_events.put(pending)
+
+
+def apply_file_watcher_events():
+    # Reloads the files in context that the watcher reported changed, on the event loop thread
+    pending = set()
+    while True:
+        try:
+            pending |= file_watcher_events.get_nowait()
+        except queue.Empty:
+            break
+    if not pending:
+        return
+    tracked = {os.path.abspath(path): path for path in list(file_contents.file_stats)}
+    changed = {}
+    for absolute_path in pending:
+        path = tracked.get(absolute_path)
+        if path is None:
+            continue
+        try:
+            diff = file_contents.refresh(path)
+        except Exception as e:
+            logging.error(f"Error reloading {path}: {str(e)}")
+            continue
+        if diff is not None:
+            changed[path] = diff
+    record_file_changes(changed)
+
+
+def record_file_changes(changed):
+    for path, diff in changed.items():
+        if not diff:
+            continue
+        lines = diff.splitlines(keepends=True)
+        if len(lines) > MAX_FILE_CHANGE_DIFF_LINES:
+            diff = "".join(lines[:MAX_FILE_CHANGE_DIFF_LINES]) + f"... ({len(lines) - MAX_FILE_CHANGE_DIFF_LINES} more diff lines)\n"
+        file_change_notes.append((path, diff))
+        unreported_file_changes.append(path)
+    while len(file_change_notes) > MAX_FILE_CHANGE_NOTES:
+        file_change_notes.popleft()
+
+
+def start_file_watcher():
+    global file_watcher
+    if WATCH_FILES and file_watcher is None:
+        file_watcher = FileWatcher(WATCH_ROOT)
+        file_watcher.start()
+    return file_watcher
+
+
+def stop_file_watcher():
+    global file_watcher
+    if file_watcher is not None:
+        file_watcher.stop()
+        file_watcher = None
+
+
+class CodeEditorMemory:
+    # code_editor_memory, grouped by file. Each file keeps its latest edit responses verbatim and
+    # condenses older ones into one-line summaries. Files are ordered by last edit, and the least
+    # recently edited ones are condensed, then evicted, to keep the rendered memory within
+    # CODE_EDITOR_MEMORY_TOKEN_BUDGET however long the session runs.
+    def __init__(self):
+        self.files = {}
+
+    def __len__(self):
+        return sum(len(group["recent"]) + len(group["summaries"]) for group in self.files.values())
+
+    def clear(self):
+        self.files.clear()
+
+    def add(self, path, instructions, response_text):
+        group = self.files.pop(path, None) or {"recent": deque(), "summaries": deque()}
+        self.files[path] = group
+        response_text = response_text.strip()
+        if len(response_text) > CODE_EDITOR_MEMORY_ENTRY_CHARS:
+            response_text = response_text[:CODE_EDITOR_MEMORY_ENTRY_CHARS] + "\n... (truncated)"
+        group["recent"].append((instructions, response_text))
+        while len(group["recent"]) > CODE_EDITOR_MEMORY_RECENT_ENTRIES:
+            self.condense_oldest(group)
+        while len(self.files) > CODE_EDITOR_MEMORY_MAX_FILES:
+            del self.files[next(iter(self.files))]
+        # Condense, then evict, starting from the least recently edited file, never the one just edited
+        while estimate_tokens(self.render()) > CODE_EDITOR_MEMORY_TOKEN_BUDGET:
+            older = [group for group in list(self.files.values())[:-1] if group["recent"]]
+            if older:
+                self.condense_oldest(older[0])
+            elif len(self.files) > 1:
+                del self.files[next(iter(self.files))]
+            elif len(group["recent"]) > 1:
+                self.condense_oldest(group)
+            else:
+                break
+
+    @staticmethod
+    def condense_oldest(group):
+        instructions, response_text = group["recent"].popleft()
+        group["summaries"].append(summarize_edit_response(instructions, response_text))
+        while len(group["summaries"]) > CODE_EDITOR_MEMORY_SUMMARIES_PER_FILE:
+            group["summaries"].popleft()
+
+    def snapshot(self):
+        return [
+            [path, list(group["summaries"]), [list(entry) for entry in group["recent"]]]
+            for path, group in self.files.items()
+        ]
+
+    def restore(self, snapshot):
+        self.files = {
+            path: {"recent": deque(tuple(entry) for entry in recent), "summaries": deque(summaries)}
+            for path, summaries, recent in snapshot
+        }
+
+    def render(self):
+        sections = []
+        for path, group in self.files.items():
+            lines = [f"Edits to {path}:"]
+            lines.extend(f"- {summary}" for summary in group["summaries"])
+            for _, response_text in group["recent"]:
+                lines.append(f"Edit Instructions for {path}:\n{response_text}")
+            sections.append("\n".join(lines))
+        return "\n\n".join(sections)
+
+
+def summarize_edit_response(instructions, response_text):
+    blocks = json.loads(parse_search_replace_blocks(response_text))
+    request = " ".join(instructions.split())
+    summary = f"\"{request[:100]}{'...' if len(request) > 100 else ''}\": {len(blocks)} SEARCH/REPLACE blocks"
+    changes = []
+    for block in blocks[:3]:
+        search_line = next((line.strip() for line in block["search"].splitlines() if line.strip()), "")
+        replace_line = next((line.strip() for line in block["replace"].splitlines() if line.strip()), "")
+        changes.append(f"`{search_line[:60]}` -> `{replace_line[:60]}`")
+    if changes:
+        summary += " (" + "; ".join(changes) + (f"; {len(blocks) - 3} more" if len(blocks) > 3 else "") + ")"
+    return summary
+
 
 # Set up the conversation memory (maintains context for MAINMODEL)
 conversation_history = []
 
 # Store file contents (part of the context for MAINMODEL)
-file_contents = {}
+file_contents = FileContextStore()
+
+# File watcher and the batches of changed paths it queued for the event loop, diffs of files in
+# context changed outside this conversation not yet shown to the model, and the paths changed
+# since the last report to the user
+file_watcher = None
+file_watcher_events = queue.SimpleQueue()
+file_change_notes = deque()
+unreported_file_changes = []
+
+# Estimated token count of conversation_history after the last compaction
+conversation_tokens = 0
 
 # Code editor memory (maintains some context for CODEEDITORMODEL between calls)
-code_editor_memory = []
+code_editor_memory = CodeEditorMemory()
 
 # Files already present in code editor's context
 code_editor_files = set()
 
+# Imports, definitions and outline of each file in context, keyed by path -> (content, info)
+editor_context_cache = {}
+
 # automode flag
 automode = False
 
-# Store file contents
-file_contents = {}
+# Directory listings keyed by absolute path -> (directory mtime, entries) and parsed .gitignore
+# files keyed by absolute path -> (mtime, rules), both reused until the mtime changes
+directory_index_cache = {}
+gitignore_cache = {}
+
+# Paths whose file_contents entry is a bounded view of a large file rather than its full content
+partial_file_views = set()
+
+# Rendered system prompt blocks for each file in context, keyed by path -> (content, hash, block).
+# Ordered by last change so that unchanged files form a stable prompt prefix.
+file_prompt_segments = {}
+
+# Last assembled system prompt prefix, keyed by the (path, hash) of every file segment
+system_prompt_prefix_cache = {'key': None, 'prompt': None}
+
+# Shared HTTP session for Tavily searches and searches currently in flight (query key -> task)
+search_session = None
+search_in_flight = {}
+
+# On-disk cache of search results
+search_cache_db = None
+
+# On-disk symbol index used by read_symbol, shared by the tool threads. symbol_index_lock guards
+# the connection and the paths marked dirty since the last project scan.
+symbol_index_db = None
+symbol_index_lock = threading.Lock()
+symbol_index_dirty = set()
+symbol_index_scanned_at = 0.0
+
+# On-disk trigram index used by search_code. code_index_lock guards the connection and the paths
+# the file watcher marked dirty, code_index_update_lock allows one index update at a time.
+code_index_db = None
+code_index_lock = threading.Lock()
+code_index_update_lock = threading.Lock()
+code_index_dirty = set()
+code_index_ready = threading.Event()
+code_index_scanned_at = 0.0
+code_index_thread = None
+
+# Model providers by name, created on first use, and token usage per agent role plus a record
+# of the most recent calls
+providers = {}
+role_token_totals = {}
+usage_records = deque()
+
+# Append-only log of the current session, see SessionStore
+session_store = None
+
+# Chat log appended to after every automode iteration
+automode_chat_log = None
+
+# Checkpoint of the automode run in progress, see AutomodeRun
+automode_run = None
+
+# Path locks shared by the goal agents while execute_goals runs them concurrently
+goal_file_locks = None
 
 # Global dictionary to store running processes
 running_processes = {}
@@ -67,6 +478,107 @@ running_processes = {}
 CONTINUATION_EXIT_PHRASE = "AUTOMODE_COMPLETE"
 MAX_CONTINUATION_ITERATIONS = 25
 MAX_CONTEXT_TOKENS = 200000  # Reduced to 200k tokens for context window
+OLLAMA_KEEP_ALIVE = "30m"  # Keep the model (and its KV cache) loaded between calls
+CONVERSATION_TOKEN_BUDGET = 100000  # conversation_history is compacted to stay under this estimate
+CHARS_PER_TOKEN = 4  # Rough estimate, Ollama models don't expose their tokenizer
+KEEP_RECENT_TURNS = 4  # Turns that are never dropped by compaction
+STALE_TOOL_RESULT_TURNS = 2  # Tool results older than this many turns are the first to be removed
+MAX_SUMMARY_LINES = 50
+STREAM_RESPONSES = True  # Render model output token by token instead of waiting for the full completion
+STREAM_REFRESH_PER_SECOND = 8
+MAX_FILE_READ_BYTES = 200000  # Larger files are stored as a bounded view instead of in full
+LARGE_FILE_HEAD_LINES = 100
+LARGE_FILE_TAIL_LINES = 50
+LARGE_FILE_OUTLINE_ENTRIES = 200
+MAX_VIEW_CHARS = 60000  # Characters in a bounded view or a line range read, however long its lines are
+MAX_VIEW_LINE_CHARS = 2000  # Longer lines in a view or range are cut with a marker
+BINARY_CHECK_BYTES = 8192
+BINARY_CONTROL_CHAR_RATIO = 0.3  # Share of control characters in the first bytes above which a file counts as binary
+FILE_READ_WORKERS = 16  # Threads used by read_multiple_files, file reads are I/O bound
+PROVIDER_TIMEOUT = 120  # Seconds to wait for a connection or the next chunk of a response
+PROVIDER_REQUEST_TIMEOUT = 900  # Upper bound on a whole model call, streaming included
+PROVIDER_MAX_RETRIES = 3
+PROVIDER_BACKOFF_BASE = 1.0  # Seconds before the first retry, doubled (with jitter) on each one after
+PROVIDER_MAX_CONNECTIONS = 8  # Ollama connection pool, shared by every role using it
+PROVIDER_MAX_TOKENS = 8000  # Completion limit, required by Anthropic
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504, 529}
+CHAT_EXPORT_CHUNK_CHARS = 65536  # save_chat writes in chunks of about this size
+AUTOMODE_CHAT_LOG_FORMAT = "md"  # Automode runs are logged as they go in this format ("md", "json" or None)
+SESSION_DIR = ".sessions"
+SESSION_FSYNC = True  # fsync every event so a crash loses at most the one being written
+SESSION_CHECKPOINT_EVENTS = 200  # Events between checkpoints, bounds the work of a resume
+SESSION_BLOB_MIN_CHARS = 1024  # Tool outputs at least this long are stored once by hash
+AUTOMODE_CHECKPOINT_DIR = ".automode"
+AUTOMODE_REPLAYABLE_TOOLS = {"create_folder", "create_file", "edit_and_apply", "tavily_search"}  # Answered from the tool log when a resumed run repeats them
+USAGE_RECORD_LIMIT = 1000  # Most recent model calls kept in usage_records
+MAX_PARALLEL_TOOL_CALLS = 8  # Upper bound on tool calls from one model turn running at the same time
+MAX_PARALLEL_GOALS = 3  # Goal agents running at the same time in execute_goals
+AUTOMODE_CONCURRENT_GOALS = False  # Run the goals set in automode's first response through execute_goals
+AUTOMODE_STALL_ITERATIONS = 3  # Iterations in a row without progress before automode is redirected, then stopped
+AUTOMODE_SIMILARITY_THRESHOLD = 0.9  # Responses at least this similar to a recent one count as a repeat
+AUTOMODE_SIMILARITY_CHARS = 2000  # Characters of each response compared
+AUTOMODE_REDIRECT_PROMPT = (
+    "The last iterations made no progress: no files changed and the same tool calls or answers came back. "
+    "Don't repeat them. Try a different approach to the remaining work, or say 'AUTOMODE_COMPLETE' if the original request is done."
+)
+MAX_LIST_ENTRIES = 2000  # list_files output is truncated beyond this many entries
+WATCH_FILES = True  # Watch the project for outside changes to files in context
+WATCH_ROOT = "."
+WATCH_IGNORED_DIRS = {"code_execution_env", ".git", "__pycache__", "node_modules"}
+WATCH_DEBOUNCE_SECONDS = 0.3
+MAX_FILE_CHANGE_NOTES = 10  # Recent outside changes described to the model
+MAX_FILE_CHANGE_DIFF_LINES = 60
+
+CODE_EDITOR_CONTEXT_TOKEN_BUDGET = 20000  # Other files sent to the code editor, ranked by relevance to the edit
+CODE_EDITOR_OUTLINE_ENTRIES = 40  # Definitions listed for a file that doesn't fit in full
+CODE_EDITOR_MEMORY_TOKEN_BUDGET = 4000  # Upper bound on the code editor memory sent with every edit
+CODE_EDITOR_MEMORY_MAX_FILES = 8  # Least recently edited files are forgotten beyond this
+CODE_EDITOR_MEMORY_RECENT_ENTRIES = 2  # Edit responses kept verbatim per file, older ones are summarized
+CODE_EDITOR_MEMORY_SUMMARIES_PER_FILE = 5
+CODE_EDITOR_MEMORY_ENTRY_CHARS = 4000
+SYMBOL_INDEX_PATH = ".symbol_index.sqlite3"
+SYMBOL_INDEX_EXTENSIONS = {
+    ".py", ".pyi", ".js", ".jsx", ".mjs", ".ts", ".tsx", ".go", ".rs", ".java", ".kt", ".scala", ".swift",
+    ".c", ".h", ".cc", ".cpp", ".hpp", ".cs", ".rb", ".php"
+}
+MAX_SYMBOL_INDEX_FILE_BYTES = 2000000
+MAX_SYMBOL_MATCHES = 5  # Bodies returned by one read_symbol call, further matches are only listed
+CODE_INDEX_PATH = ".code_index.sqlite3"
+MAX_CODE_INDEX_FILE_BYTES = 1000000  # Larger files are left out of the search index
+CODE_INDEX_BATCH_SIZE = 200  # Files indexed per transaction while building the index
+CODE_INDEX_RESCAN_SECONDS = 300  # Full rescan interval, catches changes the watcher missed
+CODE_INDEX_STALE_SECONDS = 30  # Full rescan interval when there is no inotify watcher to report changes
+MAX_CODE_SEARCH_MATCHES = 50  # Matching lines returned by one search_code call
+CODE_SEARCH_CONTEXT_LINES = 2
+MAX_CODE_SEARCH_LINE_CHARS = 300
+
+SEARCH_CACHE_PATH = ".tavily_cache.sqlite3"
+SEARCH_CACHE_TTL = 24 * 60 * 60  # Seconds before a cached search result is considered stale
+SEARCH_CACHE_MAX_ENTRIES = 500  # Least recently used results are evicted beyond this
+SEARCH_TIMEOUT = 30
+SEARCH_MAX_CONNECTIONS = 4
+
+# Tools that never modify the project and can run alongside any other tool call on different paths
+PARALLEL_SAFE_TOOLS = {"read_file", "read_multiple_files", "read_symbol", "search_code", "list_files", "tavily_search"}
+
+# Import statements (Python, JS/TS require and import, Go/Rust string imports) and identifiers,
+# used to rank files by relevance for the code editor
+IMPORT_PATTERN = re.compile(
+    r'^[ \t]*(?:from[ \t]+([\w.]+)[ \t]+import\b|import[ \t]+([\w.]+(?:[ \t]+as[ \t]+\w+)?(?:[ \t]*,[ \t]*[\w.]+(?:[ \t]+as[ \t]+\w+)?)*)[ \t]*$|.*?(?:\bfrom[ \t]+|\brequire\([ \t]*|^[ \t]*import[ \t]+)[\'"]([^\'"]+)[\'"])',
+    re.MULTILINE
+)
+IDENTIFIER_PATTERN = re.compile(r'[A-Za-z_]\w{3,}')
+
+# Explicit goal dependencies ("depends on Goal 2", "after goals 1 and 3") and the file names a goal
+# mentions, used by execute_goals to find the goals that can run at the same time
+GOAL_DEPENDENCY_PATTERN = re.compile(r'\b(?:depends?\s+on(?:\s+goals?)?|after\s+goals?)\s*(\d+(?:\s*(?:,|and|&)\s*(?:goals?\s*)?\d+)*)', re.IGNORECASE)
+GOAL_PATH_PATTERN = re.compile(r'(?<![\w/.-])(?:[\w.-]+/)*[\w-]+\.[A-Za-z]\w{0,7}(?![\w/])|(?<![\w/.-])(?:[\w.-]+/)+[\w.-]*')
+
+# Thread pool shared by bulk file reads
+file_read_executor = ThreadPoolExecutor(max_workers=FILE_READ_WORKERS, thread_name_prefix="file-read")
+
+# The search cache connection lives on this one thread, so cache reads and writes stay off the event loop
+search_cache_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="search-cache")
 
 # Models
 # Models that maintain context memory across interactions
@@ -76,6 +588,18 @@ MAINMODEL = "mistral-nemo"  # Maintains conversation history and file contents
 TOOLCHECKERMODEL = "mistral-nemo"
 CODEEDITORMODEL = "mistral-nemo"
 
+# Provider serving each model: "ollama", "anthropic" or "mock" (offline, for tests)
+MAINMODEL_PROVIDER = os.getenv("MAINMODEL_PROVIDER", "ollama")
+TOOLCHECKERMODEL_PROVIDER = os.getenv("TOOLCHECKERMODEL_PROVIDER", "ollama")
+CODEEDITORMODEL_PROVIDER = os.getenv("CODEEDITORMODEL_PROVIDER", "ollama")
+
+# Agent roles -> (provider, model), see call_model
+ROLE_MODELS = {
+    "main": (MAINMODEL_PROVIDER, MAINMODEL),
+    "tool_checker": (TOOLCHECKERMODEL_PROVIDER, TOOLCHECKERMODEL),
+    "code_editor": (CODEEDITORMODEL_PROVIDER, CODEEDITORMODEL),
+}
+
 # System prompts
 BASE_SYSTEM_PROMPT = """
 You are Ollama Engineer, an AI assistant powered Ollama models, specialized in software development with access to a variety of tools and the ability to instruct and direct a coding agent and a code execution one. Your capabilities include:
@@ -99,12 +623,15 @@ Available tools and their optimal use cases:
    - Include ALL the snippets of code to change, along with the desired modifications.
    - Specify coding standards, naming conventions, or architectural patterns to be followed.
    - Anticipate potential issues or conflicts that might arise from the changes and provide guidance on how to handle them.
+   - When the changes are confined to one class or function, pass it as symbol so the agent only receives that part of the file.
 4. execute_code: Run Python code exclusively in the 'code_execution_env' virtual environment and analyze its output. Use this when you need to test code functionality or diagnose issues. Remember that all code execution happens in this isolated environment. This tool now returns a process ID for long-running processes.
 5. stop_process: Stop a running process by its ID. Use this when you need to terminate a long-running process started by the execute_code tool.
-6. read_file: Read the contents of an existing file.
+6. read_file: Read the contents of an existing file. Large files are stored as a bounded view (head, outline and tail); pass start_line and end_line to read a specific range of lines.
 7. read_multiple_files: Read the contents of multiple existing files at once. Use this when you need to examine or work with multiple files simultaneously.
-8. list_files: List all files and directories in a specified folder.
-9. tavily_search: Perform a web search using the Tavily API for up-to-date information.
+8. read_symbol: Read only the source of a class or function (optionally in a given file), with its line range. Prefer this over read_file when you need a single definition.
+9. search_code: Search the project for a string or regular expression and get ranked matches with surrounding lines. Use this to find where something is defined or used instead of reading files to look for it.
+10. list_files: List files and directories in a specified folder with their sizes. Set recursive (optionally with max_depth and a glob pattern) to walk a whole tree in one call; .gitignore rules are respected.
+11. tavily_search: Perform a web search using the Tavily API for up-to-date information.
 
 Tool Usage Guidelines:
 - Always use the most appropriate tool for the task at hand.
@@ -175,25 +702,73 @@ Remember: Focus on completing the established goals efficiently and effectively.
 """
 
 
-def update_system_prompt(current_iteration: Optional[int] = None, max_iterations: Optional[int] = None) -> str:
-    global file_contents
-    chain_of_thought_prompt = """
+CHAIN_OF_THOUGHT_PROMPT = """
     Answer the user's request using relevant tools (if they are available). Before calling a tool, do some analysis within <thinking></thinking> tags. First, think about which of the provided tools is the relevant tool to answer the user's request. Second, go through each of the required parameters of the relevant tool and determine if the user has directly provided or given enough information to infer a value. When deciding if the parameter can be inferred, carefully consider all the context to see if it supports a specific value. If all of the required parameters are present or can be reasonably inferred, close the thinking tag and proceed with the tool call. BUT, if one of the values for a required parameter is missing, DO NOT invoke the function (not even with fillers for the missing params) and instead, ask the user to provide the missing parameters. DO NOT ask for more information on optional parameters if it is not provided.
 
     Do not reflect on the quality of the returned search results in your response.
     """
-    
-    file_contents_prompt = "\n\nFile Contents:\n"
-    for path, content in file_contents.items():
-        file_contents_prompt += f"\n--- {path} ---\n{content}\n"
-    
+
+
+def render_file_segment(path, content):
+    cached = file_prompt_segments.get(path)
+    # Strings are immutable, so the same object means the same content and no rehash is needed
+    if cached and cached[0] is content:
+        return cached[2]
+    digest = hashlib.sha256(content.encode('utf-8')).hexdigest()
+    if cached and cached[1] == digest:
+        file_prompt_segments[path] = (content, digest, cached[2])
+        return cached[2]
+    # Changed or new segments move to the end so the unchanged ones keep a stable prefix
+    file_prompt_segments.pop(path, None)
+    block = f"\n--- {path} ---\n{content}\n"
+    file_prompt_segments[path] = (content, digest, block)
+    return block
+
+
+def build_file_segments():
+    # Watcher events, then a cheap stat-based check, so the prompt never carries content that changed on disk
+    apply_file_watcher_events()
+    record_file_changes(file_contents.revalidate())
+    if unreported_file_changes:
+        changed = list(dict.fromkeys(unreported_file_changes))
+        unreported_file_changes.clear()
+        console.print(Panel("\n".join(changed), title="Files Changed on Disk, Context Updated", title_align="left", border_style="yellow", expand=False))
+    for path in [p for p in file_prompt_segments if p not in file_contents]:
+        del file_prompt_segments[path]
+    # Tool threads may add files while the prompt is built, iterate over a snapshot
+    for path, content in list(file_contents.items()):
+        render_file_segment(path, content)
+    return file_prompt_segments
+
+
+def get_system_prompt_prefix() -> str:
+    # The part of the system prompt that only changes when files in context change.
+    # Keeping it byte-identical between calls lets Ollama reuse its KV cache.
+    global system_prompt_prefix_cache
+    segments = build_file_segments()
+    prefix_key = tuple((path, digest) for path, (_, digest, _) in segments.items())
+    if system_prompt_prefix_cache['key'] != prefix_key:
+        prefix = BASE_SYSTEM_PROMPT + CHAIN_OF_THOUGHT_PROMPT + "\n\nFile Contents:\n" + "".join(block for _, _, block in segments.values())
+        system_prompt_prefix_cache = {'key': prefix_key, 'prompt': prefix}
+    return system_prompt_prefix_cache['prompt']
+
+
+def update_system_prompt(current_iteration: Optional[int] = None, max_iterations: Optional[int] = None, clear_notes: bool = True) -> str:
+    prompt = get_system_prompt_prefix()
     if automode:
         iteration_info = ""
         if current_iteration is not None and max_iterations is not None:
             iteration_info = f"You are currently on iteration {current_iteration} out of {max_iterations} in automode."
-        return BASE_SYSTEM_PROMPT + file_contents_prompt + "\n\n" + AUTOMODE_SYSTEM_PROMPT.format(iteration_info=iteration_info) + "\n\n" + chain_of_thought_prompt
-    else:
-        return BASE_SYSTEM_PROMPT + file_contents_prompt + "\n\n" + chain_of_thought_prompt
+        prompt += "\n\n" + AUTOMODE_SYSTEM_PROMPT.format(iteration_info=iteration_info)
+    # Outside changes go after the stable prefix so they don't invalidate the KV cache. Each one is
+    # described once, the File Contents carry it from then on. Goal agents running side by side
+    # leave the notes for the turn their results are merged into.
+    if file_change_notes:
+        prompt += "\n\nRecent changes made outside this conversation to files in context (the File Contents above are already up to date):\n"
+        prompt += "\n".join(diff for _, diff in file_change_notes)
+        if clear_notes:
+            file_change_notes.clear()
+    return prompt
 
 def create_folder(path):
     try:
@@ -207,7 +782,12 @@ def create_file(path, content=""):
     try:
         with open(path, 'w') as f:
             f.write(content)
-        file_contents[path] = content
+            f.flush()
+            stat = os.fstat(f.fileno())
+        file_contents.store(path, content, stat)
+        partial_file_views.discard(path)
+        mark_code_index_dirty([path])
+        mark_symbol_index_dirty([path])
         return f"File created and added to system prompt: {path}"
     except Exception as e:
         return f"Error creating file: {str(e)}"
@@ -262,17 +842,99 @@ def generate_and_apply_diff(original_content, new_content, path):
         return f"Error applying changes: {str(e)}"
 
 
+def get_editor_context_info(path, content):
+    # Imports, defined names, identifiers and outline of a context file, cached until its content changes
+    cached = editor_context_cache.get(path)
+    if cached and cached[0] is content:
+        return cached[1]
+    imports = set()
+    for match in IMPORT_PATTERN.finditer(content):
+        python_from, python_import, quoted = match.groups()
+        if python_from:
+            imports.add(python_from.lstrip(".").replace(".", "/"))
+        elif python_import:
+            imports.update(name.split()[0].replace(".", "/") for name in python_import.split(","))
+        else:
+            imports.add(re.sub(r'\.(?:js|jsx|mjs|ts|tsx)$', '', re.sub(r'^(?:\.\.?/)+', '', quoted)))
+    imports.discard("")
+    symbols = collect_symbols(path, content)
+    info = {
+        "imports": imports,
+        "defined": {name for name, *_ in symbols if len(name) >= 4},
+        "identifiers": set(IDENTIFIER_PATTERN.findall(content)),
+        "outline": [f"  L{start_line}-{end_line}: {kind} {qualname}" for _, qualname, kind, start_line, end_line in symbols],
+        "tokens": estimate_tokens(content),
+    }
+    editor_context_cache[path] = (content, info)
+    return info
+
+def imports_file(imports, path):
+    # True if one of the module paths (e.g. "pkg/module" or "components/Button") resolves to path
+    stem = os.path.splitext(os.path.normpath(path))[0].replace(os.sep, "/")
+    if stem.endswith("/__init__") or stem.endswith("/index"):
+        stem = stem.rsplit("/", 1)[0]
+    return any(stem == module or stem.endswith("/" + module) for module in imports)
+
+def select_editor_context(file_path, file_content, instructions, full_file_contents, budget=CODE_EDITOR_CONTEXT_TOKEN_BUDGET):
+    # Ranks the other files in context by relevance to the edit (mentioned in the instructions,
+    # import graph in both directions, shared symbols, then recency) and packs them into budget:
+    # relevant files in full while they fit, then outlines, then just their names
+    for path in [p for p in editor_context_cache if p not in full_file_contents]:
+        del editor_context_cache[path]
+    target = get_editor_context_info(file_path, file_content)
+    instruction_identifiers = set(IDENTIFIER_PATTERN.findall(instructions))
+    wanted = target["identifiers"] | instruction_identifiers
+    recent = {path: i for i, path in enumerate(file_prompt_segments)}
+
+    ranked = []
+    for path, content in list(full_file_contents.items()):
+        if path == file_path or path.startswith(f"{file_path} ("):
+            continue
+        info = get_editor_context_info(path, content)
+        score = 0
+        if path in instructions or os.path.basename(path.split(" (")[0]) in instructions:
+            score += 20
+        if imports_file(target["imports"], path):
+            score += 15
+        if imports_file(info["imports"], file_path):
+            score += 10
+        score += min(2 * len(info["defined"] & wanted), 10)
+        score += min(len(target["defined"] & info["identifiers"]), 5)
+        ranked.append((score, recent.get(path, -1), path, content, info))
+    ranked.sort(key=lambda entry: (-entry[0], -entry[1], entry[2]))
+
+    sections = []
+    omitted = []
+    remaining = budget
+    counts = {"full": 0, "outline": 0}
+    for score, _, path, content, info in ranked:
+        outline = "\n".join(info["outline"][:CODE_EDITOR_OUTLINE_ENTRIES])
+        if score > 0 and info["tokens"] <= remaining:
+            sections.append(f"--- {path} ---\n{content}")
+            remaining -= info["tokens"]
+            counts["full"] += 1
+        elif outline and estimate_tokens(outline) <= remaining:
+            sections.append(f"--- {path} (outline only, read it in full if needed) ---\n{outline}")
+            remaining -= estimate_tokens(outline)
+            counts["outline"] += 1
+        else:
+            omitted.append(path)
+    if omitted:
+        sections.append("Other files in context (not shown): " + ", ".join(omitted))
+    console.print(
+        f"Code editor context: {counts['full']} files in full, {counts['outline']} as outlines, "
+        f"{len(omitted)} omitted (~{budget - remaining} tokens)", style="dim"
+    )
+    return "\n\n".join(sections)
+
 async def generate_edit_instructions(file_path, file_content, instructions, project_context, full_file_contents):
-    global code_editor_tokens, code_editor_memory, code_editor_files
+    global code_editor_files
     try:
         # Prepare memory context (this is the only part that maintains some context between calls)
-        memory_context = "\n".join([f"Memory {i+1}:\n{mem}" for i, mem in enumerate(code_editor_memory)])
+        memory_context = code_editor_memory.render()
 
-        # Prepare full file contents context, excluding the file being edited if it's already in code_editor_files
-        full_file_contents_context = "\n\n".join([
-            f"--- {path} ---\n{content}" for path, content in full_file_contents.items()
-            if path != file_path or path not in code_editor_files
-        ])
+        # Only the files most relevant to this edit, within CODE_EDITOR_CONTEXT_TOKEN_BUDGET
+        full_file_contents_context = select_editor_context(file_path, file_content, instructions, full_file_contents)
 
         system_prompt = f"""
         You are an AI coding agent that generates edit instructions for code files. Your task is to analyze the provided code and generate SEARCH/REPLACE blocks for necessary changes. Follow these steps:
@@ -319,24 +981,18 @@ async def generate_edit_instructions(file_path, file_content, instructions, proj
         """
 
         # Make the API call to CODEEDITORMODEL (context is not maintained except for code_editor_memory)
-        response = client.messages.create(
-            model=CODEEDITORMODEL,
-            max_tokens=8000,
-            system=system_prompt,
-            extra_headers={"anthropic-beta": "max-tokens-3-5-sonnet-2024-07-15"},
-            messages=[
-                {"role": "user", "content": "Generate SEARCH/REPLACE blocks for the necessary changes."}
-            ]
-        )
-        # Update token usage for code editor
-        code_editor_tokens['input'] += response.usage.input_tokens
-        code_editor_tokens['output'] += response.usage.output_tokens
+        response = await call_model("code_editor", [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": "Generate SEARCH/REPLACE blocks for the necessary changes."}
+        ])
 
         # Parse the response to extract SEARCH/REPLACE blocks
-        edit_instructions = parse_search_replace_blocks(response.content[0].text)
+        edit_instructions = parse_search_replace_blocks(response["content"])
 
         # Update code editor memory (this is the only part that maintains some context between calls)
-        code_editor_memory.append(f"Edit Instructions for {file_path}:\n{response.content[0].text}")
+        code_editor_memory.add(file_path, instructions, response["content"])
+        if session_store is not None:
+            session_store.log_editor_memory(file_path, instructions, response["content"])
 
         # Add the file to code_editor_files set
         code_editor_files.add(file_path)
@@ -345,7 +1001,7 @@ async def generate_edit_instructions(file_path, file_content, instructions, proj
 
     except Exception as e:
         console.print(f"Error in generating edit instructions: {str(e)}", style="bold red")
-        return []  # Return empty list if any exception occurs
+        return None  # The call already went through call_model's retries, edit_and_apply gives up
 
 
 
@@ -363,17 +1019,49 @@ def parse_search_replace_blocks(response_text):
     return json.dumps(blocks)  # Keep returning JSON string
 
 
-async def edit_and_apply(path, instructions, project_context, is_automode=False, max_retries=3):
+def get_symbol_edit_context(path, symbol):
+    # The code editor only receives the lines of symbol, and none of the file's other context entries
+    matches = find_symbols(symbol, path)
+    if not matches:
+        return None, None
+    _, qualname, kind, start_line, end_line = matches[0]
+    symbol_content = (
+        f"[Only lines {start_line}-{end_line} of {path} ({kind} {qualname}) are shown. "
+        f"Limit the SEARCH blocks to these lines.]\n"
+        f"{read_line_range(path, start_line, end_line)}"
+    )
+    other_files = {
+        context_path: content for context_path, content in list(file_contents.items())
+        if context_path != path and not context_path.startswith(f"{path} (")
+    }
+    return symbol_content, other_files
+
+async def edit_and_apply(path, instructions, project_context, is_automode=False, max_retries=3, symbol=None):
     global file_contents
     try:
         original_content = file_contents.get(path, "")
-        if not original_content:
+        # Bounded views of large files can't be edited, the edits are applied to the full file. Only
+        # the symbol's lines of a large file go to the code editor, never the whole file.
+        if not original_content or path in partial_file_views:
+            if not symbol and (path in partial_file_views or os.path.getsize(path) > MAX_FILE_READ_BYTES):
+                return (f"Error editing/applying to file: {path} is too large to send to the code editor whole. "
+                        f"Pass symbol to limit the edit to one class or function.")
             with open(path, 'r') as file:
+                stat = os.fstat(file.fileno())
                 original_content = file.read()
-            file_contents[path] = original_content
+            if path not in partial_file_views:
+                file_contents.store(path, original_content, stat)
 
         for attempt in range(max_retries):
-            edit_instructions_json = await generate_edit_instructions(path, original_content, instructions, project_context, file_contents)
+            editor_content, editor_files = original_content, file_contents
+            if symbol:
+                # Looked up again on every attempt, earlier attempts may have moved the symbol
+                editor_content, editor_files = await asyncio.to_thread(get_symbol_edit_context, path, symbol)
+                if editor_content is None:
+                    return f"Error editing/applying to file: symbol '{symbol}' was not found in {path}"
+            edit_instructions_json = await generate_edit_instructions(path, editor_content, instructions, project_context, editor_files)
+            if edit_instructions_json is None:
+                return f"Error editing/applying to file: the code editor model could not be reached for {path}"
             
             if edit_instructions_json:
                 edit_instructions = json.loads(edit_instructions_json)  # Parse JSON here
@@ -385,7 +1073,11 @@ async def edit_and_apply(path, instructions, project_context, is_automode=False,
                 edited_content, changes_made, failed_edits = await apply_edits(path, edit_instructions, original_content)
 
                 if changes_made:
-                    file_contents[path] = edited_content  # Update the file_contents with the new content
+                    # Update the file_contents with the new content
+                    if path in partial_file_views:
+                        load_file_into_context(path)
+                    else:
+                        file_contents[path] = edited_content
                     console.print(Panel(f"File contents updated in system prompt: {path}", style="green"))
                     
                     if failed_edits:
@@ -408,11 +1100,162 @@ async def edit_and_apply(path, instructions, project_context, is_automode=False,
 
 
 
+def build_line_index(content):
+    # One pass over the file: offsets and indentation of every non-blank line, its whitespace-normalized
+    # text, and a map from normalized text to the positions where it occurs.
+    lines = []
+    line_index = {}
+    offset = 0
+    for line in content.splitlines(keepends=True):
+        stripped = line.strip()
+        if stripped:
+            indent = line[:len(line) - len(line.lstrip())]
+            end = offset + len(line.rstrip())
+            normalized = " ".join(stripped.split())
+            line_index.setdefault(normalized, []).append(len(lines))
+            lines.append((normalized, offset, end, indent))
+        offset += len(line)
+    return lines, line_index
+
+
+def get_indent_shift(search_indents, file_indents):
+    # The (added, removed) indentation that turns every SEARCH line's indentation into the file's,
+    # or None if the lines are shifted by different amounts
+    shift = None
+    for search_indent, file_indent in zip(search_indents, file_indents):
+        if file_indent.startswith(search_indent):
+            line_shift = (file_indent[len(search_indent):], "")
+        elif search_indent.startswith(file_indent):
+            line_shift = ("", search_indent[len(file_indent):])
+        else:
+            return None
+        if shift is not None and line_shift != shift:
+            return None
+        shift = line_shift
+    return shift
+
+
+def find_fuzzy_span(lines, line_index, search_content):
+    # Match the search block line by line, ignoring indentation, runs of whitespace and blank lines.
+    # Returns (start, end, shift) for each match, the span covering whole lines so that the replacement
+    # can be re-indented by shift (see get_indent_shift), which is None if the indentation is inconsistent.
+    search_lines = [line for line in search_content.splitlines() if line.strip()]
+    if not search_lines:
+        return []
+    normalized = [" ".join(line.split()) for line in search_lines]
+    search_indents = [line[:len(line) - len(line.lstrip())] for line in search_lines]
+    spans = []
+    for start in line_index.get(normalized[0], []):
+        end = start + len(normalized)
+        if end <= len(lines) and all(lines[start + k][0] == search_line for k, search_line in enumerate(normalized)):
+            shift = get_indent_shift(search_indents, [line[3] for line in lines[start:end]])
+            spans.append((lines[start][1], lines[end - 1][2], shift))
+    return spans
+
+
+def reindent_block(content, shift):
+    # Applies an indentation shift to every non-blank line, None if a line is indented less than it removes
+    added, removed = shift
+    reindented = []
+    for line in content.splitlines():
+        if line.strip():
+            if not line.startswith(removed):
+                return None
+            line = added + line[len(removed):]
+        reindented.append(line)
+    return "\n".join(reindented)
+
+
+def iter_exact_spans(content, search_content):
+    position = content.find(search_content)
+    while position != -1:
+        yield position, position + len(search_content)
+        position = content.find(search_content, position + 1)
+
+
+def locate_edits(content, edit_instructions, numbers=None):
+    # Finds the SEARCH blocks (all of them, or the edit numbers given) in content and checks that the
+    # matches don't overlap. Returns (located, failed) where located is a list of
+    # (start, end, edit number, search, replace).
+    line_index = None
+    located = []
+    failed = []
+    taken = []
+
+    for i in numbers or range(1, len(edit_instructions) + 1):
+        edit = edit_instructions[i - 1]
+        search_content = edit['search'].strip()
+        # Strip <SEARCH> and <REPLACE> tags from replace_content
+        replace_content = re.sub(r'</?SEARCH>|</?REPLACE>', '', edit['replace'])
+
+        if not search_content:
+            failed.append((i, search_content, "content not found"))
+            continue
+
+        candidates = iter_exact_spans(content, search_content)
+        first = next(candidates, None)
+        if first is None:
+            if line_index is None:
+                line_index = build_line_index(content)
+            matches = find_fuzzy_span(*line_index, edit['search'])
+            candidates = iter([match for match in matches if match[2] is not None])
+            first = next(candidates, None)
+            if first is None:
+                reason = "indentation differs from the file by a different amount on each line" if matches else "content not found"
+                failed.append((i, search_content, reason))
+                continue
+
+        # Use the first match that doesn't overlap an earlier edit
+        span = next((c for c in itertools.chain([first], candidates) if all(c[1] <= t[0] or c[0] >= t[1] for t in taken)), None)
+        if span is None:
+            failed.append((i, search_content, "overlaps another edit"))
+            continue
+
+        if len(span) == 3:
+            # Whitespace-tolerant match of whole lines, indent the replacement like the file
+            replace_content = reindent_block(replace_content.strip("\r\n").rstrip(), span[2])
+            if replace_content is None:
+                failed.append((i, search_content, "REPLACE is indented less than the matched lines allow"))
+                continue
+        else:
+            replace_content = replace_content.strip()
+
+        taken.append(span[:2])
+        located.append((span[0], span[1], i, search_content, replace_content))
+
+    located.sort()
+    return located, failed
+
+
+def splice_edits(content, located):
+    # Rebuilds content once from the untouched stretches and the replacements
+    pieces = []
+    previous_end = 0
+    for start, end, _, _, replace_content in located:
+        pieces.append(content[previous_end:start])
+        pieces.append(replace_content)
+        previous_end = end
+    pieces.append(content[previous_end:])
+    return "".join(pieces)
+
+
 async def apply_edits(file_path, edit_instructions, original_content):
-    changes_made = False
-    edited_content = original_content
     total_edits = len(edit_instructions)
-    failed_edits = []
+    located, failed = locate_edits(original_content, edit_instructions)
+    passes = [(original_content, located)]
+    edited_content = splice_edits(original_content, located)
+
+    # A block may target text that an earlier block inserted, so blocks not found in the original
+    # are looked up again in the edited content, as if the edits were applied one after another
+    retry = [i for i, _, reason in failed if reason == "content not found"]
+    if located and retry:
+        later, failed_again = locate_edits(edited_content, edit_instructions, retry)
+        failed = sorted([f for f in failed if f[0] not in retry] + failed_again)
+        passes.append((edited_content, later))
+        edited_content = splice_edits(edited_content, later)
+
+    failed_edits = [f"Edit {i} ({reason}): {search_content}" for i, search_content, reason in failed]
+    changes_made = bool(located)
 
     with Progress(
         SpinnerColumn(),
@@ -423,37 +1266,25 @@ async def apply_edits(file_path, edit_instructions, original_content):
     ) as progress:
         edit_task = progress.add_task("[cyan]Applying edits...", total=total_edits)
 
-        for i, edit in enumerate(edit_instructions, 1):
-            search_content = edit['search'].strip()
-            replace_content = edit['replace'].strip()
-            
-            # Use regex to find the content, ignoring leading/trailing whitespace
-            pattern = re.compile(re.escape(search_content), re.DOTALL)
-            match = pattern.search(edited_content)
-            
-            if match:
-                # Replace the content, preserving the original whitespace
-                start, end = match.span()
-                # Strip <SEARCH> and <REPLACE> tags from replace_content
-                replace_content_cleaned = re.sub(r'</?SEARCH>|</?REPLACE>', '', replace_content)
-                edited_content = edited_content[:start] + replace_content_cleaned + edited_content[end:]
-                changes_made = True
-                
-                # Display the diff for this edit
-                diff_result = generate_diff(search_content, replace_content, file_path)
-                console.print(Panel(diff_result, title=f"Changes in {file_path} ({i}/{total_edits})", style="cyan"))
-            else:
-                console.print(Panel(f"Edit {i}/{total_edits} not applied: content not found", style="yellow"))
-                failed_edits.append(f"Edit {i}: {search_content}")
-
+        for i, search_content, reason in failed:
+            console.print(Panel(f"Edit {i}/{total_edits} not applied: {reason}", style="yellow"))
             progress.update(edit_task, advance=1)
 
+        # Display the diff for each edit
+        for content, pass_located in passes:
+            for start, end, i, search_content, replace_content in pass_located:
+                diff_result = generate_diff(content[start:end], replace_content, file_path)
+                console.print(Panel(diff_result, title=f"Changes in {file_path} ({i}/{total_edits})", style="cyan"))
+                progress.update(edit_task, advance=1)
+
     if not changes_made:
         console.print(Panel("No changes were applied. The file content already matches the desired state.", style="green"))
     else:
         # Write the changes to the file
         with open(file_path, 'w') as file:
             file.write(edited_content)
+        mark_code_index_dirty([file_path])
+        mark_symbol_index_dirty([file_path])
         console.print(Panel(f"Changes have been written to {file_path}", style="green"))
 
     return edited_content, changes_made, "\n".join(failed_edits)
@@ -472,40 +1303,980 @@ def generate_diff(original, new, path):
 
     return highlighted_diff
 
-def read_file(path):
-    global file_contents
+# Definitions and other landmarks listed in the outline of a large file
+OUTLINE_PATTERN = re.compile(
+    rb'^[ \t]*(?:(?:export[ \t]+)?(?:async[ \t]+)?(?:def|class|function|interface|struct|enum|impl|trait|fn|func|module)\b|#{1,6}[ \t])[^\n]*',
+    re.MULTILINE
+)
+
+def get_text_encoding(path):
+    # The encoding to read a text file with, or None if it looks binary: NUL bytes (outside UTF-16
+    # with a byte order mark) or a high share of control characters. Text that isn't UTF-8, like
+    # Latin-1, is still text, readers decode it with errors="replace".
+    with open(path, 'rb') as f:
+        chunk = f.read(BINARY_CHECK_BYTES)
+    if chunk.startswith((codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE)):
+        return 'utf-16'
+    if b'\0' in chunk:
+        return None
+    control = sum(1 for byte in chunk if byte < 32 and byte not in b'\t\n\r\f\b\x1b')
+    if chunk and control / len(chunk) > BINARY_CONTROL_CHAR_RATIO:
+        return None
+    return 'utf-8'
+
+def is_binary_file(path):
+    return get_text_encoding(path) is None
+
+def read_bounded_text(mm, start, end, budget):
+    # Decodes mm[start:end] line by line, cutting lines longer than MAX_VIEW_LINE_CHARS and stopping
+    # with a marker once budget characters are used, without copying more of the map than is shown
+    pieces = []
+    used = 0
+    position = start
+    while position < end:
+        if used >= budget:
+            pieces.append(f"[... truncated, {end - position} more bytes not shown]\n")
+            break
+        newline = mm.find(b'\n', position, end)
+        line_end = end if newline == -1 else newline + 1
+        limit = min(MAX_VIEW_LINE_CHARS, budget - used)
+        # A character takes at most 4 bytes in UTF-8
+        text = mm[position:min(line_end, position + limit * 4)].decode('utf-8', 'replace')
+        if line_end - position > limit * 4 or len(text) > limit:
+            text = text[:limit]
+            pieces.append(f"{text} [... line cut, {line_end - position} bytes in total]\n")
+        else:
+            pieces.append(text)
+        used += len(text)
+        position = line_end
+    return "".join(pieces)
+
+def read_file_view(path):
+    # Builds a bounded view of a large file from a memory map without reading it all into memory
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        return build_file_view(mm)
+
+def build_file_view(mm):
+    # Head, outline of the middle and tail of the mapped file, each bounded in characters
+    head_end = 0
+    for _ in range(LARGE_FILE_HEAD_LINES):
+        newline = mm.find(b'\n', head_end)
+        if newline == -1:
+            head_end = len(mm)
+            break
+        head_end = newline + 1
+
+    tail_start = len(mm)
+    for _ in range(LARGE_FILE_TAIL_LINES):
+        newline = mm.rfind(b'\n', 0, tail_start - 1)
+        if newline == -1:
+            tail_start = 0
+            break
+        tail_start = newline + 1
+    tail_start = max(tail_start, head_end)
+
+    outline = []
+    line_number = 1
+    position = 0
+    for match in OUTLINE_PATTERN.finditer(mm, head_end, tail_start):
+        line_number += mm[position:match.start()].count(b'\n')
+        position = match.start()
+        outline.append(f"  L{line_number}: {match.group()[:MAX_VIEW_LINE_CHARS].decode('utf-8', 'replace').strip()}")
+        if len(outline) >= LARGE_FILE_OUTLINE_ENTRIES:
+            outline.append("  ...")
+            break
+
+    head = read_bounded_text(mm, 0, head_end, MAX_VIEW_CHARS * 2 // 3)
+    tail = read_bounded_text(mm, tail_start, len(mm), MAX_VIEW_CHARS // 3)
+
+    view = (
+        f"[Large file: {len(mm)} bytes. Showing the first {LARGE_FILE_HEAD_LINES} lines, an outline of the middle "
+        f"and the last {LARGE_FILE_TAIL_LINES} lines. Use read_file with start_line and end_line to read a specific range.]\n"
+        f"{head}"
+    )
+    if outline:
+        view += "\n[Outline]\n" + "\n".join(outline) + "\n"
+    if tail_start > head_end:
+        view += "\n[...]\n"
+    return view + tail
+
+def read_line_range(path, start_line, end_line=None):
+    # Returns lines start_line..end_line (1-based, inclusive) using a memory map to find the offsets,
+    # bounded to MAX_VIEW_CHARS like a file view
+    if os.path.getsize(path) == 0:
+        return ""
+    with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        start = 0
+        for _ in range(start_line - 1):
+            newline = mm.find(b'\n', start)
+            if newline == -1:
+                return ""
+            start = newline + 1
+        end = start
+        if end_line is None:
+            end = len(mm)
+        else:
+            for _ in range(end_line - start_line + 1):
+                newline = mm.find(b'\n', end)
+                if newline == -1:
+                    end = len(mm)
+                    break
+                end = newline + 1
+        return read_bounded_text(mm, start, end, MAX_VIEW_CHARS)
+
+def load_file_into_context(path, start_line=None, end_line=None):
+    encoding = get_text_encoding(path)
+    with open(path, 'r', encoding=encoding or 'utf-8', errors='replace') as f:
+        # Stat the handle before reading it, a write that lands during the read then shows up as a change
+        stat = os.fstat(f.fileno())
+        size = stat.st_size
+        if size and encoding is None:
+            return f"File '{path}' looks like a binary file ({size} bytes) and was not added to the system prompt."
+
+        if start_line is not None or end_line is not None:
+            start_line = max(int(start_line or 1), 1)
+            end_line = int(end_line) if end_line is not None else None
+            file_contents[f"{path} (lines {start_line}-{end_line or 'end'})"] = read_line_range(path, start_line, end_line)
+            return f"Lines {start_line}-{end_line or 'end'} of '{path}' have been read and stored in the system prompt."
+
+        if size > MAX_FILE_READ_BYTES:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                file_contents.store(path, build_file_view(mm), stat)
+            partial_file_views.add(path)
+            return (f"File '{path}' is large ({size} bytes); a bounded view has been read and stored in the system prompt. "
+                    f"Use start_line and end_line to read specific ranges.")
+
+        file_contents.store(path, f.read(), stat)
+    partial_file_views.discard(path)
+    return f"File '{path}' has been read and stored in the system prompt."
+
+def read_file(path, start_line=None, end_line=None):
     try:
-        with open(path, 'r') as f:
-            content = f.read()
-        file_contents[path] = content
-        return f"File '{path}' has been read and stored in the system prompt."
+        return load_file_into_context(path, start_line, end_line)
     except Exception as e:
         return f"Error reading file: {str(e)}"
 
+def read_context_file_safely(path):
+    try:
+        return load_file_into_context(path)
+    except Exception as e:
+        return f"Error reading file '{path}': {str(e)}"
+
+def read_context_files_safely(paths):
+    return [read_context_file_safely(path) for path in paths]
+
 def read_multiple_files(paths):
-    global file_contents
-    results = []
-    for path in paths:
+    # Reads fan out over a shared thread pool in contiguous chunks (one task per worker rather than
+    # per file), and map() keeps the chunks, and so the results, in the requested order
+    unique_paths = list(dict.fromkeys(paths))
+    if len(unique_paths) <= 1:
+        return "\n".join(read_context_files_safely(unique_paths))
+    chunk_size = -(-len(unique_paths) // FILE_READ_WORKERS)
+    chunks = [unique_paths[i:i + chunk_size] for i in range(0, len(unique_paths), chunk_size)]
+    return "\n".join(result for chunk in file_read_executor.map(read_context_files_safely, chunks) for result in chunk)
+
+def gitignore_pattern_to_regex(pattern):
+    anchored = "/" in pattern
+    pattern = pattern.lstrip("/")
+    parts = []
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            parts.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("/**", i) and i + 3 == len(pattern):
+            parts.append("(?:/.*)?")
+            i += 3
+        elif pattern.startswith("**", i):
+            parts.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            parts.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            parts.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1:]:
+            end = pattern.index("]", i + 1)
+            parts.append("[" + pattern[i + 1:end].replace("!", "^", 1) + "]")
+            i = end + 1
+        else:
+            parts.append(re.escape(pattern[i]))
+            i += 1
+    # Patterns without a slash match at any depth below the .gitignore
+    return re.compile(("" if anchored else "(?:.*/)?") + "".join(parts) + "$")
+
+def load_gitignore(directory):
+    # Returns the parsed rules of directory/.gitignore as (regex, negated, directories_only)
+    path = os.path.join(directory, ".gitignore")
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return []
+    cached = gitignore_cache.get(path)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    rules = []
+    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.rstrip("\n").rstrip()
+            if not line or line.startswith("#"):
+                continue
+            negated = line.startswith("!")
+            if negated:
+                line = line[1:]
+            directories_only = line.endswith("/")
+            line = line.rstrip("/")
+            if line:
+                rules.append((gitignore_pattern_to_regex(line), negated, directories_only))
+    gitignore_cache[path] = (mtime, rules)
+    return rules
+
+def is_gitignored(relative_path, is_dir, rule_sets):
+    # rule_sets holds (prefix, strip, rules): the path relative to a .gitignore's directory is
+    # prefix + relative_path[strip:]. The last matching rule wins, as in git.
+    ignored = False
+    for prefix, strip, rules in rule_sets:
+        candidate = prefix + relative_path[strip:]
+        for regex, negated, directories_only in rules:
+            if directories_only and not is_dir:
+                continue
+            if regex.match(candidate):
+                ignored = not negated
+    return ignored
+
+def scan_directory(directory):
+    # Entries of a directory as (name, is_dir, is_symlink, size). The names are cached until the
+    # directory's mtime changes, sizes are stat'ed on every call since rewriting a file in place
+    # leaves the directory's mtime alone.
+    key = os.path.abspath(directory)
+    mtime = os.stat(key).st_mtime_ns
+    cached = directory_index_cache.get(key)
+    if not cached or cached[0] != mtime:
+        names = []
+        with os.scandir(key) as iterator:
+            for entry in iterator:
+                try:
+                    names.append((entry.name, entry.is_dir(follow_symlinks=False), entry.is_symlink()))
+                except OSError:
+                    continue
+        names.sort()
+        cached = (mtime, names)
+        directory_index_cache[key] = cached
+    entries = []
+    for name, is_dir, is_symlink in cached[1]:
+        if is_dir:
+            entries.append((name, is_dir, is_symlink, 0))
+            continue
         try:
-            with open(path, 'r') as f:
-                content = f.read()
-            file_contents[path] = content
-            results.append(f"File '{path}' has been read and stored in the system prompt.")
-        except Exception as e:
-            results.append(f"Error reading file '{path}': {str(e)}")
-    return "\n".join(results)
+            size = os.stat(os.path.join(key, name), follow_symlinks=False).st_size
+        except OSError:
+            continue
+        entries.append((name, is_dir, is_symlink, size))
+    return entries
+
+def get_gitignore_rule_sets(root):
+    # .gitignore files between the repository root and root (an absolute path) also apply below it
+    rule_sets = []
+    ancestor = root
+    while True:
+        rules = load_gitignore(ancestor)
+        if rules:
+            relative = os.path.relpath(root, ancestor).replace(os.sep, "/")
+            rule_sets.insert(0, ("" if relative == "." else relative + "/", 0, rules))
+        parent = os.path.dirname(ancestor)
+        if os.path.isdir(os.path.join(ancestor, ".git")) or parent == ancestor:
+            break
+        ancestor = parent
+    return rule_sets
+
+def iter_project_files(root="."):
+    # Yields (path, size) for every file below root that isn't gitignored or in WATCH_IGNORED_DIRS
+    stack = [(root, "", get_gitignore_rule_sets(os.path.abspath(root)))]
+    while stack:
+        directory, relative_dir, directory_rule_sets = stack.pop()
+        if relative_dir:
+            rules = load_gitignore(directory)
+            if rules:
+                directory_rule_sets = directory_rule_sets + [("", len(relative_dir), rules)]
+        for name, is_dir, is_symlink, size in scan_directory(directory):
+            if is_symlink or (is_dir and name in WATCH_IGNORED_DIRS):
+                continue
+            relative_path = relative_dir + name
+            if is_gitignored(relative_path, is_dir, directory_rule_sets):
+                continue
+            path = os.path.join(directory, name)
+            if is_dir:
+                stack.append((path, relative_path + "/", directory_rule_sets))
+            else:
+                yield os.path.normpath(path), size
 
-def list_files(path="."):
+def list_files(path=".", recursive=False, max_depth=None, pattern=None):
     try:
-        files = os.listdir(path)
-        return "\n".join(files)
+        root = os.path.abspath(path)
+        if not os.path.isdir(root):
+            return f"Error listing files: '{path}' is not a directory"
+        if max_depth is None:
+            max_depth = None if recursive else 1
+
+        lines = []
+        total = 0
+        stack = [(root, "", 1, get_gitignore_rule_sets(root))]
+        while stack:
+            directory, relative_dir, depth, directory_rule_sets = stack.pop()
+            if relative_dir:
+                rules = load_gitignore(directory)
+                if rules:
+                    directory_rule_sets = directory_rule_sets + [("", len(relative_dir), rules)]
+            subdirectories = []
+            for name, is_dir, is_symlink, size in scan_directory(directory):
+                if name == ".git":
+                    continue
+                relative_path = relative_dir + name
+                if is_gitignored(relative_path, is_dir, directory_rule_sets):
+                    continue
+                if pattern is None or fnmatch.fnmatch(relative_path if "/" in pattern else name, pattern):
+                    total += 1
+                    if len(lines) < MAX_LIST_ENTRIES:
+                        if is_dir:
+                            lines.append(f"{relative_path}/")
+                        else:
+                            lines.append(f"{relative_path}  ({size} bytes{', symlink' if is_symlink else ''})")
+                if is_dir and not is_symlink and (max_depth is None or depth < max_depth):
+                    subdirectories.append((os.path.join(directory, name), relative_path + "/", depth + 1, directory_rule_sets))
+            # Reversed so that the depth-first walk visits subdirectories in sorted order
+            stack.extend(reversed(subdirectories))
+
+        if total > len(lines):
+            lines.append(f"... {total - len(lines)} more entries not shown. Narrow the listing with path, max_depth or pattern.")
+        return "\n".join(lines) if lines else "No files found."
     except Exception as e:
         return f"Error listing files: {str(e)}"
 
-def tavily_search(query):
+# Definitions recognised by the ctags-style fallback for languages other than Python
+SYMBOL_PATTERN = re.compile(
+    r'^([ \t]*)(?:(?:export|default|public|private|protected|internal|static|abstract|final|async|unsafe|extern|inline|pub(?:\([^)]*\))?)[ \t]+)*'
+    r'(class|interface|struct|enum|impl|trait|fn|func|function\*?|def|module|type)[ \t]+(?:\([^)]*\)[ \t]*)?([A-Za-z_$][\w$]*)',
+    re.MULTILINE
+)
+# Methods of brace languages written without a keyword (JS/TS classes, Java, C#, C++)
+METHOD_PATTERN = re.compile(
+    r'^([ \t]+)(?:[\w<>\[\],.?*&:]+[ \t]+)*?([A-Za-z_$~][\w$]*)[ \t]*\([^;{}]*\)[^;{}=]*\{[ \t]*$',
+    re.MULTILINE
+)
+METHOD_PATTERN_EXCLUDED = {"if", "for", "while", "switch", "catch", "return", "function", "with", "else", "do", "new", "await", "typeof"}
+SYMBOL_STRING_OR_COMMENT = re.compile(r'"(?:\\.|[^"\\])*"|\'(?:\\.|[^\'\\])*\'|`[^`]*`|//.*|#.*')
+
+def collect_python_symbols(source):
+    # (name, qualname, kind, start_line, end_line) of every class and function, decorators included
+    symbols = []
+
+    def visit(node, prefix, in_class):
+        for child in ast.iter_child_nodes(node):
+            if isinstance(child, (ast.FunctionDef, ast.AsyncFunctionDef, ast.ClassDef)):
+                is_class = isinstance(child, ast.ClassDef)
+                kind = "class" if is_class else ("method" if in_class else "function")
+                start_line = min([child.lineno] + [decorator.lineno for decorator in child.decorator_list])
+                symbols.append((child.name, prefix + child.name, kind, start_line, child.end_lineno))
+                visit(child, prefix + child.name + ".", is_class)
+            elif isinstance(child, (ast.stmt, ast.excepthandler)):
+                # Definitions inside if/try/with blocks belong to the enclosing scope
+                visit(child, prefix, in_class)
+
+    visit(ast.parse(source), "", False)
+    return symbols
+
+def find_block_end(lines, start_index, indent):
+    # Brace-delimited blocks end where the braces balance again; blocks without braces end
+    # before the next non-blank line indented no deeper than the definition
+    depth = 0
+    opened = False
+    for i in range(start_index, len(lines)):
+        code = SYMBOL_STRING_OR_COMMENT.sub("", lines[i])
+        if not opened and ";" in code and "{" not in code:
+            return i
+        for char in code:
+            if char == "{":
+                depth += 1
+                opened = True
+            elif char == "}":
+                depth -= 1
+        if opened and depth <= 0:
+            return i
+        if not opened and i >= start_index + 2:
+            break
+
+    end = start_index
+    for i in range(start_index + 1, len(lines)):
+        stripped = lines[i].strip()
+        if not stripped:
+            continue
+        if len(lines[i]) - len(lines[i].lstrip()) <= indent:
+            if stripped in ("end", "}", "};"):
+                end = i
+            break
+        end = i
+    return end
+
+def collect_fallback_symbols(source):
+    lines = source.split("\n")
+    line_starts = list(itertools.accumulate((len(line) + 1 for line in lines), initial=0))
+    definitions = {}
+    for match in SYMBOL_PATTERN.finditer(source):
+        keyword = match.group(2).rstrip("*")
+        kind = "function" if keyword in ("fn", "func", "function", "def") else keyword
+        definitions[match.start()] = (match.group(1), match.group(3), kind)
+    for match in METHOD_PATTERN.finditer(source):
+        if match.start() not in definitions and match.group(2) not in METHOD_PATTERN_EXCLUDED:
+            definitions[match.start()] = (match.group(1), match.group(2), "method")
+
+    symbols = []
+    enclosing = []
+    for offset in sorted(definitions):
+        indentation, name, kind = definitions[offset]
+        start_index = bisect.bisect_right(line_starts, offset) - 1
+        end_index = find_block_end(lines, start_index, len(indentation.expandtabs()))
+        while enclosing and enclosing[-1][1] < start_index:
+            enclosing.pop()
+        if kind == "method" and not enclosing:
+            continue  # Calls and other statements at the top level look like methods too
+        qualname = ".".join([parent for parent, _ in enclosing] + [name])
+        symbols.append((name, qualname, kind, start_index + 1, end_index + 1))
+        enclosing.append((name, end_index))
+    return symbols
+
+def collect_symbols(path, source):
+    if path.endswith((".py", ".pyi")):
+        try:
+            return collect_python_symbols(source)
+        except (SyntaxError, ValueError):
+            pass
+    return collect_fallback_symbols(source)
+
+def get_symbol_index():
+    global symbol_index_db
+    if symbol_index_db is None:
+        # Tools run on worker threads, every use of the connection holds symbol_index_lock
+        symbol_index_db = sqlite3.connect(SYMBOL_INDEX_PATH, check_same_thread=False)
+        symbol_index_db.execute(
+            "CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, digest TEXT)"
+        )
+        symbol_index_db.execute(
+            "CREATE TABLE IF NOT EXISTS symbols "
+            "(path TEXT, name TEXT, qualname TEXT, kind TEXT, start_line INTEGER, end_line INTEGER)"
+        )
+        symbol_index_db.execute("CREATE INDEX IF NOT EXISTS symbols_by_name ON symbols (name)")
+        symbol_index_db.execute("CREATE INDEX IF NOT EXISTS symbols_by_path ON symbols (path)")
+    return symbol_index_db
+
+def index_file_symbols(db, path):
+    # Re-parses path only when its content hash changed; unchanged stats skip even the hash.
+    # Returns True if the symbols of the file were rewritten.
+    stat = os.stat(path)
+    row = db.execute("SELECT mtime_ns, size, digest FROM files WHERE path = ?", (path,)).fetchone()
+    if row and row[0] == stat.st_mtime_ns and row[1] == stat.st_size:
+        return False
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if row and row[2] == digest:
+        db.execute("UPDATE files SET mtime_ns = ?, size = ? WHERE path = ?", (stat.st_mtime_ns, stat.st_size, path))
+        return False
+
+    symbols = []
+    if b'\0' not in data[:BINARY_CHECK_BYTES]:
+        symbols = collect_symbols(path, data.decode('utf-8', 'replace'))
+    db.execute("DELETE FROM symbols WHERE path = ?", (path,))
+    db.executemany(
+        "INSERT INTO symbols (path, name, qualname, kind, start_line, end_line) VALUES (?, ?, ?, ?, ?, ?)",
+        [(path, *symbol) for symbol in symbols]
+    )
+    db.execute(
+        "INSERT OR REPLACE INTO files (path, mtime_ns, size, digest) VALUES (?, ?, ?, ?)",
+        (path, stat.st_mtime_ns, stat.st_size, digest)
+    )
+    return True
+
+def remove_file_symbols(db, path):
+    db.execute("DELETE FROM symbols WHERE path = ?", (path,))
+    db.execute("DELETE FROM files WHERE path = ?", (path,))
+
+def mark_symbol_index_dirty(paths):
+    with symbol_index_lock:
+        symbol_index_dirty.update(os.path.normpath(os.path.relpath(path)) for path in paths)
+
+def update_symbol_index(path=None):
+    # Brings the index up to date for one file, or for every source file in the project. The project
+    # is walked on the first lookup and then on the same schedule as the code index; in between only
+    # the dirty paths are re-indexed, plus the already indexed files whose stat changed when there is
+    # no inotify watcher to report changes.
+    global symbol_index_scanned_at
+    inotify = file_watcher is not None and file_watcher.mode == "inotify"
+    rescan_seconds = CODE_INDEX_RESCAN_SECONDS if inotify else CODE_INDEX_STALE_SECONDS
+    with symbol_index_lock:
+        db = get_symbol_index()
+        if path is not None:
+            index_file_symbols(db, os.path.normpath(path))
+        elif time.time() - symbol_index_scanned_at < rescan_seconds:
+            dirty = set(symbol_index_dirty)
+            symbol_index_dirty.clear()
+            if not inotify:
+                dirty.update(indexed for (indexed,) in db.execute("SELECT path FROM files"))
+            for file_path in dirty:
+                try:
+                    size = os.stat(file_path).st_size
+                except OSError:
+                    remove_file_symbols(db, file_path)
+                    continue
+                if (os.path.splitext(file_path)[1] not in SYMBOL_INDEX_EXTENSIONS or size > MAX_SYMBOL_INDEX_FILE_BYTES
+                        or is_project_path_ignored(file_path)):
+                    remove_file_symbols(db, file_path)
+                    continue
+                try:
+                    index_file_symbols(db, file_path)
+                except OSError:
+                    remove_file_symbols(db, file_path)
+        else:
+            scan_started = time.time()
+            symbol_index_dirty.clear()
+            seen = set()
+            for file_path, size in iter_project_files("."):
+                if os.path.splitext(file_path)[1] not in SYMBOL_INDEX_EXTENSIONS or size > MAX_SYMBOL_INDEX_FILE_BYTES:
+                    continue
+                seen.add(file_path)
+                try:
+                    index_file_symbols(db, file_path)
+                except OSError:
+                    seen.discard(file_path)
+            stale = [(indexed,) for (indexed,) in db.execute("SELECT path FROM files") if indexed not in seen]
+            db.executemany("DELETE FROM symbols WHERE path = ?", stale)
+            db.executemany("DELETE FROM files WHERE path = ?", stale)
+            symbol_index_scanned_at = scan_started
+        db.commit()
+
+def find_symbols(symbol, path=None):
+    # Matches "name" or a dotted "Class.method" qualname, exact qualname matches first
+    update_symbol_index(path)
+    name = symbol.rsplit(".", 1)[-1]
+    query = "SELECT path, qualname, kind, start_line, end_line FROM symbols WHERE name = ?"
+    parameters = [name]
+    if path is not None:
+        query += " AND path = ?"
+        parameters.append(os.path.normpath(path))
+    with symbol_index_lock:
+        rows = get_symbol_index().execute(query + " ORDER BY path, start_line", parameters).fetchall()
+    if "." in symbol:
+        rows = [row for row in rows if row[1] == symbol or row[1].endswith("." + symbol)]
+    return sorted(rows, key=lambda row: row[1] != symbol)
+
+def read_symbol(symbol, path=None):
     try:
-        response = tavily.qna_search(query=query, search_depth="advanced")
-        return response
+        matches = find_symbols(symbol, path)
+        if not matches:
+            where = f"'{path}'" if path else "the project"
+            return f"Symbol '{symbol}' was not found in {where}."
+        sections = []
+        for match_path, qualname, kind, start_line, end_line in matches[:MAX_SYMBOL_MATCHES]:
+            body = read_line_range(match_path, start_line, end_line)
+            sections.append(f"{match_path}, lines {start_line}-{end_line} ({kind} {qualname}):\n{body}")
+        if len(matches) > MAX_SYMBOL_MATCHES:
+            others = [f"  {match_path}:{start_line} {qualname}" for match_path, qualname, _, start_line, _ in matches[MAX_SYMBOL_MATCHES:]]
+            sections.append(f"{len(others)} more matches not shown, pass path to narrow the lookup:\n" + "\n".join(others))
+        return "\n\n".join(sections)
+    except Exception as e:
+        return f"Error reading symbol: {str(e)}"
+
+def is_project_path_ignored(path, root="."):
+    # Same rules as iter_project_files, for a single path reported by the file watcher
+    relative = os.path.relpath(path, root).replace(os.sep, "/")
+    if relative.startswith("../"):
+        return True
+    parts = relative.split("/")
+    rule_sets = get_gitignore_rule_sets(os.path.abspath(root))
+    directory = root
+    relative_dir = ""
+    for i, part in enumerate(parts):
+        if relative_dir:
+            rules = load_gitignore(directory)
+            if rules:
+                rule_sets = rule_sets + [("", len(relative_dir), rules)]
+        is_dir = i < len(parts) - 1
+        if (is_dir and part in WATCH_IGNORED_DIRS) or is_gitignored(relative_dir + part, is_dir, rule_sets):
+            return True
+        directory = os.path.join(directory, part)
+        relative_dir += part + "/"
+    return False
+
+def get_code_index():
+    global code_index_db
+    if code_index_db is None:
+        # Raises sqlite3.OperationalError when SQLite was built without FTS5, search_code then scans the files
+        db = sqlite3.connect(CODE_INDEX_PATH, check_same_thread=False)
+        db.execute("CREATE TABLE IF NOT EXISTS code_files (id INTEGER PRIMARY KEY, path TEXT UNIQUE, mtime_ns INTEGER, size INTEGER, digest TEXT)")
+        db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS code_text USING fts5(content, tokenize='trigram')")
+        code_index_db = db
+    return code_index_db
+
+def remove_code_file(db, path):
+    row = db.execute("SELECT id FROM code_files WHERE path = ?", (path,)).fetchone()
+    if row:
+        db.execute("DELETE FROM code_text WHERE rowid = ?", row)
+        db.execute("DELETE FROM code_files WHERE id = ?", row)
+
+def index_code_file(db, path):
+    # Re-indexes path when its content hash changed, binary and oversized files are left out
+    try:
+        stat = os.stat(path)
+    except OSError:
+        remove_code_file(db, path)
+        return
+    row = db.execute("SELECT id, mtime_ns, size, digest FROM code_files WHERE path = ?", (path,)).fetchone()
+    if row and row[1] == stat.st_mtime_ns and row[2] == stat.st_size:
+        return
+    if stat.st_size > MAX_CODE_INDEX_FILE_BYTES:
+        remove_code_file(db, path)
+        return
+    with open(path, 'rb') as f:
+        data = f.read()
+    digest = hashlib.sha256(data).hexdigest()
+    if row and row[3] == digest:
+        db.execute("UPDATE code_files SET mtime_ns = ?, size = ? WHERE id = ?", (stat.st_mtime_ns, stat.st_size, row[0]))
+        return
+    try:
+        if b'\0' in data[:BINARY_CHECK_BYTES]:
+            raise UnicodeDecodeError("utf-8", data, 0, 1, "binary file")
+        content = data.decode('utf-8')
+    except UnicodeDecodeError:
+        remove_code_file(db, path)
+        return
+    if row:
+        db.execute("UPDATE code_files SET mtime_ns = ?, size = ?, digest = ? WHERE id = ?", (stat.st_mtime_ns, stat.st_size, digest, row[0]))
+        db.execute("DELETE FROM code_text WHERE rowid = ?", (row[0],))
+        file_id = row[0]
+    else:
+        file_id = db.execute(
+            "INSERT INTO code_files (path, mtime_ns, size, digest) VALUES (?, ?, ?, ?)",
+            (path, stat.st_mtime_ns, stat.st_size, digest)
+        ).lastrowid
+    db.execute("INSERT INTO code_text (rowid, content) VALUES (?, ?)", (file_id, content))
+
+def mark_code_index_dirty(paths):
+    with code_index_lock:
+        code_index_dirty.update(os.path.normpath(os.path.relpath(path)) for path in paths)
+
+def update_code_index():
+    # Rescans the whole project until the index is built and then once the last scan is older than
+    # CODE_INDEX_RESCAN_SECONDS with an inotify watcher (a safety net) or CODE_INDEX_STALE_SECONDS
+    # without one; in between only the paths marked dirty, by the watcher or by our own writes, are
+    # re-indexed, plus the indexed files whose stat changed when there is no inotify watcher. Callers hold code_index_update_lock. A full scan commits in batches so that searches
+    # can use the partial index while it is being built.
+    global code_index_scanned_at
+    inotify = file_watcher is not None and file_watcher.mode == "inotify"
+    rescan_seconds = CODE_INDEX_RESCAN_SECONDS if inotify else CODE_INDEX_STALE_SECONDS
+    incremental = code_index_ready.is_set() and time.time() - code_index_scanned_at < rescan_seconds
+    if incremental:
+        with code_index_lock:
+            db = get_code_index()
+            dirty = set(code_index_dirty)
+            code_index_dirty.clear()
+            if not inotify:
+                # Nothing reports outside edits, stat the indexed files (index_code_file skips unchanged ones)
+                dirty.update(path for (path,) in db.execute("SELECT path FROM code_files"))
+            for path in dirty:
+                if os.path.isfile(path) and not is_project_path_ignored(path):
+                    index_code_file(db, path)
+                else:
+                    remove_code_file(db, path)
+            db.commit()
+        return
+
+    scan_started = time.time()
+    with code_index_lock:
+        db = get_code_index()
+        indexed = {path for (path,) in db.execute("SELECT path FROM code_files")}
+    seen = set()
+    files = iter_project_files(".")
+    while True:
+        batch = list(itertools.islice(files, CODE_INDEX_BATCH_SIZE))
+        if not batch:
+            break
+        with code_index_lock:
+            for path, _ in batch:
+                seen.add(path)
+                try:
+                    index_code_file(db, path)
+                except OSError:
+                    continue
+            db.commit()
+    with code_index_lock:
+        for path in indexed - seen:
+            remove_code_file(db, path)
+        db.commit()
+    code_index_scanned_at = scan_started
+    code_index_ready.set()
+
+def build_code_index():
+    with code_index_update_lock:
+        try:
+            update_code_index()
+        except Exception as e:
+            logging.error(f"Error building the code search index: {str(e)}")
+
+def start_code_index():
+    # The first build runs in the background, search_code uses whatever is indexed until it is done
+    global code_index_thread
+    if code_index_thread is None:
+        code_index_thread = threading.Thread(target=build_code_index, name="code-index", daemon=True)
+        code_index_thread.start()
+    return code_index_thread
+
+def required_literals(pattern):
+    # Literal runs of 3+ characters that every match of the regex contains, used to narrow the
+    # candidates through the trigram index. Text in groups, classes and optional characters is
+    # skipped, and a top-level alternation can't be narrowed at all.
+    literals = []
+    run = ""
+    depth = 0
+    i = 0
+    while i < len(pattern):
+        char = pattern[i]
+        literal = None
+        if char == "\\" and i + 1 < len(pattern):
+            if not pattern[i + 1].isalnum():
+                literal = pattern[i + 1]
+            i += 2
+        elif char == "[":
+            end = pattern.find("]", i + 2)
+            i = len(pattern) if end == -1 else end + 1
+        elif char == "{":
+            end = pattern.find("}", i)
+            run = run[:-1]
+            i = len(pattern) if end == -1 else end + 1
+        else:
+            i += 1
+            if char == "|" and depth == 0:
+                return []
+            if char == "(":
+                depth += 1
+            elif char == ")":
+                depth -= 1
+            elif char in "?*":
+                run = run[:-1]
+            elif char not in ".^$+|":
+                literal = char
+        if literal is not None and depth == 0:
+            run += literal
+        else:
+            literals.append(run)
+            run = ""
+    literals.append(run)
+    return [literal for literal in literals if len(literal) >= 3]
+
+def iter_code_search_candidates(literals):
+    # (path, content) of every file that can contain a match: narrowed through the trigram index
+    # when the query has literals, every indexed file otherwise. The candidate ids are collected
+    # under code_index_lock and their content fetched in batches, the lock is never held while the
+    # caller matches.
+    with code_index_lock:
+        try:
+            db = get_code_index()
+        except sqlite3.OperationalError:
+            db = None  # SQLite without FTS5, read the project files instead
+        else:
+            query = "SELECT rowid FROM code_text"
+            if literals:
+                match = " AND ".join('"' + literal.replace('"', '""') + '"' for literal in literals)
+                candidates = [rowid for (rowid,) in db.execute(query + " WHERE code_text MATCH ?", (match,))]
+            else:
+                candidates = [rowid for (rowid,) in db.execute(query)]
+    if db is None:
+        for path, size in iter_project_files("."):
+            if size <= MAX_CODE_INDEX_FILE_BYTES and not is_binary_file(path):
+                with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                    yield path, f.read()
+        return
+    for start in range(0, len(candidates), CODE_INDEX_BATCH_SIZE):
+        batch = candidates[start:start + CODE_INDEX_BATCH_SIZE]
+        with code_index_lock:
+            rows = db.execute(
+                "SELECT f.path, t.content FROM code_text t JOIN code_files f ON f.id = t.rowid "
+                f"WHERE t.rowid IN ({', '.join('?' * len(batch))})",
+                batch
+            ).fetchall()
+        yield from rows
+
+def search_code(query, path=None, regex=False, case_sensitive=False, context_lines=CODE_SEARCH_CONTEXT_LINES):
+    try:
+        started = time.perf_counter()
+        matcher = re.compile(query if regex else re.escape(query), 0 if case_sensitive else re.IGNORECASE)
+        literals = required_literals(query) if regex else [query]
+        literals = [literal for literal in literals if len(literal) >= 3]
+        context_lines = max(int(context_lines), 0)
+
+        # Bring the index up to date unless its first build is still running in the background
+        if code_index_update_lock.acquire(blocking=code_index_ready.is_set()):
+            try:
+                update_code_index()
+            finally:
+                code_index_update_lock.release()
+        building = not code_index_ready.is_set()
+
+        prefix = None if path in (None, "", ".") else os.path.normpath(path)
+        results = []
+        for file_path, content in iter_code_search_candidates(literals):
+            if prefix and file_path != prefix and not file_path.startswith(prefix + os.sep):
+                continue
+            matched_lines = []
+            line_number = 1
+            position = 0
+            for match in matcher.finditer(content):
+                line_number += content.count("\n", position, match.start())
+                position = match.start()
+                if not matched_lines or matched_lines[-1] != line_number:
+                    matched_lines.append(line_number)
+            if not matched_lines:
+                continue
+            lines = content.split("\n")
+            # Definitions outrank uses, and a match in the file name ranks the whole file higher
+            score = len(matched_lines)
+            score += sum(5 for n in matched_lines if SYMBOL_PATTERN.match(lines[n - 1]) or METHOD_PATTERN.match(lines[n - 1]))
+            if matcher.search(os.path.basename(file_path)):
+                score += 10
+            results.append((score, file_path, matched_lines, lines))
+
+        if not results:
+            return f"No matches for '{query}'" + (" (the search index is still being built)." if building else ".")
+
+        results.sort(key=lambda result: (-result[0], result[1]))
+        total = sum(len(result[2]) for result in results)
+        sections = []
+        shown = 0
+        for _, file_path, matched_lines, lines in results:
+            if shown >= MAX_CODE_SEARCH_MATCHES:
+                break
+            matched_lines = matched_lines[:MAX_CODE_SEARCH_MATCHES - shown]
+            shown += len(matched_lines)
+            matched = set(matched_lines)
+            output = [f"{file_path}:"]
+            last = 0
+            for n in matched_lines:
+                first = max(n - context_lines, last + 1, 1)
+                if last and first > last + 1:
+                    output.append("  --")
+                for line_number in range(first, min(n + context_lines, len(lines)) + 1):
+                    text = lines[line_number - 1]
+                    if len(text) > MAX_CODE_SEARCH_LINE_CHARS:
+                        text = text[:MAX_CODE_SEARCH_LINE_CHARS] + "..."
+                    output.append(f"  {line_number}{':' if line_number in matched else '-'} {text}")
+                    last = line_number
+            sections.append("\n".join(output))
+
+        elapsed = (time.perf_counter() - started) * 1000
+        header = f"{total} matching lines in {len(results)} files ({elapsed:.0f} ms)"
+        if total > shown:
+            header += f", showing the {shown} best ranked. Narrow the search with path or a more specific query"
+        if building:
+            header += ". The search index is still being built, results may be incomplete"
+        return header + ":\n\n" + "\n\n".join(sections)
+    except re.error as e:
+        return f"Error searching code: invalid regular expression: {str(e)}"
+    except Exception as e:
+        return f"Error searching code: {str(e)}"
+
+def get_search_cache():
+    global search_cache_db
+    if search_cache_db is None:
+        search_cache_db = sqlite3.connect(SEARCH_CACHE_PATH)
+        search_cache_db.execute(
+            "CREATE TABLE IF NOT EXISTS search_cache "
+            "(key TEXT PRIMARY KEY, query TEXT, result TEXT, created_at REAL, last_used REAL)"
+        )
+    return search_cache_db
+
+def search_cache_get(key):
+    db = get_search_cache()
+    row = db.execute("SELECT result, created_at FROM search_cache WHERE key = ?", (key,)).fetchone()
+    if row is None:
+        return None
+    now = time.time()
+    if now - row[1] > SEARCH_CACHE_TTL:
+        db.execute("DELETE FROM search_cache WHERE key = ?", (key,))
+        db.commit()
+        return None
+    db.execute("UPDATE search_cache SET last_used = ? WHERE key = ?", (now, key))
+    db.commit()
+    return json.loads(row[0])
+
+def search_cache_put(key, query, result):
+    db = get_search_cache()
+    now = time.time()
+    db.execute(
+        "INSERT OR REPLACE INTO search_cache (key, query, result, created_at, last_used) VALUES (?, ?, ?, ?, ?)",
+        (key, query, json.dumps(result), now, now)
+    )
+    # Drop expired entries, then the least recently used ones beyond the size limit
+    db.execute("DELETE FROM search_cache WHERE created_at < ?", (now - SEARCH_CACHE_TTL,))
+    db.execute(
+        "DELETE FROM search_cache WHERE key NOT IN (SELECT key FROM search_cache ORDER BY last_used DESC LIMIT ?)",
+        (SEARCH_CACHE_MAX_ENTRIES,)
+    )
+    db.commit()
+
+def get_search_session():
+    global search_session
+    if search_session is None or search_session.closed:
+        search_session = aiohttp.ClientSession(
+            timeout=aiohttp.ClientTimeout(total=SEARCH_TIMEOUT),
+            connector=aiohttp.TCPConnector(limit=SEARCH_MAX_CONNECTIONS),
+            headers={"Authorization": f"Bearer {tavily_api_key}"}
+        )
+    return search_session
+
+def close_search_cache():
+    global search_cache_db
+    if search_cache_db is not None:
+        search_cache_db.close()
+        search_cache_db = None
+
+async def run_search_cache(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(search_cache_executor, function, *args)
+
+async def close_search_session():
+    global search_session
+    try:
+        if search_session is not None and not search_session.closed:
+            await search_session.close()
+    finally:
+        search_session = None
+        await run_search_cache(close_search_cache)
+
+async def fetch_search_answer(key, query):
+    session = get_search_session()
+    async with session.post(f"{TAVILY_API_URL}/search", json={
+        "query": query,
+        "search_depth": "advanced",
+        "include_answer": True
+    }) as response:
+        response.raise_for_status()
+        data = await response.json()
+    answer = data.get("answer", "")
+    await run_search_cache(search_cache_put, key, query, answer)
+    return answer
+
+async def tavily_search(query):
+    key = hashlib.sha256(" ".join(query.lower().split()).encode('utf-8')).hexdigest()
+    try:
+        cached = await run_search_cache(search_cache_get, key)
+        if cached is not None:
+            return cached
+
+        # Identical queries issued while a search is running share its result
+        task = search_in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(fetch_search_answer(key, query))
+            search_in_flight[key] = task
+            task.add_done_callback(lambda _: search_in_flight.pop(key, None))
+        return await asyncio.shield(task)
     except Exception as e:
         return f"Error performing search: {str(e)}"
 
@@ -567,6 +2338,10 @@ tools = [
                     "project_context": {
                         "type": "string",
                         "description": "Comprehensive context about the project"
+                    },
+                    "symbol": {
+                        "type": "string",
+                        "description": "Optional class or function (e.g. ClassName.method) the changes are limited to. Only its source is sent to the coding agent"
                     }
                 },
                 "required": ["path", "instructions", "project_context"]
@@ -584,6 +2359,14 @@ tools = [
                     "path": {
                         "type": "string",
                         "description": "The absolute or relative path of the file to read"
+                    },
+                    "start_line": {
+                        "type": "integer",
+                        "description": "Optional first line (1-based) of a range to read instead of the whole file"
+                    },
+                    "end_line": {
+                        "type": "integer",
+                        "description": "Optional last line (inclusive) of the range to read"
                     }
                 },
                 "required": ["path"]
@@ -610,17 +2393,89 @@ tools = [
             }
         }
     },
+    {
+        "type": "function",
+        "function": {
+            "name": "read_symbol",
+            "description": (
+                "Return only the source of a class or function, with its line range, from a persistent symbol index of the project. "
+                f"Without an inotify file watcher, files created outside this session can take up to {CODE_INDEX_STALE_SECONDS} seconds to be found"
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "symbol": {
+                        "type": "string",
+                        "description": "The name of the class or function, or a dotted name such as ClassName.method"
+                    },
+                    "path": {
+                        "type": "string",
+                        "description": "The file to look in. The whole project is searched when omitted"
+                    }
+                },
+                "required": ["symbol"]
+            }
+        }
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "search_code",
+            "description": (
+                "Search the project's files for a string or regular expression through a trigram index and return ranked matches with context lines. "
+                f"Without an inotify file watcher, files created outside this session can take up to {CODE_INDEX_STALE_SECONDS} seconds to be found"
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "query": {
+                        "type": "string",
+                        "description": "The text to search for, or a regular expression when regex is true"
+                    },
+                    "path": {
+                        "type": "string",
+                        "description": "Only search the files in this folder (or this file)"
+                    },
+                    "regex": {
+                        "type": "boolean",
+                        "description": "Treat the query as a regular expression. Defaults to false"
+                    },
+                    "case_sensitive": {
+                        "type": "boolean",
+                        "description": "Match case exactly. Defaults to false"
+                    },
+                    "context_lines": {
+                        "type": "integer",
+                        "description": "Lines of context shown around each match. Defaults to 2"
+                    }
+                },
+                "required": ["query"]
+            }
+        }
+    },
     {
         "type": "function",
         "function": {
             "name": "list_files",
-            "description": "List all files and directories in the specified folder",
+            "description": "List files and directories in the specified folder with sizes, optionally recursively, respecting .gitignore",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "path": {
                         "type": "string",
                         "description": "The absolute or relative path of the folder to list"
+                    },
+                    "recursive": {
+                        "type": "boolean",
+                        "description": "List the whole tree below the folder instead of only its direct entries"
+                    },
+                    "max_depth": {
+                        "type": "integer",
+                        "description": "Optional maximum depth to descend (1 lists only the folder itself)"
+                    },
+                    "pattern": {
+                        "type": "string",
+                        "description": "Optional glob to filter entries, matched against the name or, if it contains '/', the relative path"
                     }
                 }
             }
@@ -649,25 +2504,29 @@ from typing import Dict, Any
 
 async def execute_tool(tool_call: Dict[str, Any]) -> Dict[str, Any]:
     try:
-        function_call = tool_call['function']
-        tool_name = function_call['name']
-        tool_arguments = function_call['arguments']
-        
-        # Check if tool_arguments is a string and parse it if necessary
-        if isinstance(tool_arguments, str):
-            try:
-                tool_input = json.loads(tool_arguments)
-            except json.JSONDecodeError:
-                return {
-                    "content": f"Error: Failed to parse tool arguments for {tool_name}",
-                    "is_error": True
-                }
-        else:
-            tool_input = tool_arguments
+        tool_name = tool_call['function']['name']
+        tool_input = get_tool_input(tool_call)
+        if tool_input is None:
+            return {
+                "content": f"Error: Failed to parse tool arguments for {tool_name}",
+                "is_error": True
+            }
 
         result = None
         is_error = False
 
+        before = None
+        if automode_run is not None:
+            before = automode_run.path_digests(tool_name, tool_input)
+            result = automode_run.completed_result(tool_name, tool_input)
+            if result is not None:
+                if tool_name in ("create_file", "edit_and_apply") and tool_input["path"] not in file_contents:
+                    await asyncio.to_thread(load_file_into_context, tool_input["path"])
+                return {
+                    "content": f"{result}\n(Already completed before this automode run was resumed, not run again.)",
+                    "is_error": False
+                }
+
         if tool_name == "create_folder":
             if "path" not in tool_input:
                 raise KeyError("Missing 'path' parameter for create_folder")
@@ -679,20 +2538,44 @@ async def execute_tool(tool_call: Dict[str, Any]) -> Dict[str, Any]:
                 tool_input["path"],
                 tool_input["instructions"],
                 tool_input["project_context"],
-                is_automode=automode
+                is_automode=automode,
+                symbol=tool_input.get("symbol")
             )
         elif tool_name == "read_file":
-            result = read_file(tool_input["path"])
+            result = await asyncio.to_thread(read_file, tool_input["path"], tool_input.get("start_line"), tool_input.get("end_line"))
         elif tool_name == "read_multiple_files":
-            result = read_multiple_files(tool_input["paths"])
+            result = await asyncio.to_thread(read_multiple_files, tool_input["paths"])
+        elif tool_name == "read_symbol":
+            result = await asyncio.to_thread(read_symbol, tool_input["symbol"], tool_input.get("path"))
+        elif tool_name == "search_code":
+            result = await asyncio.to_thread(
+                search_code,
+                tool_input["query"],
+                tool_input.get("path"),
+                tool_input.get("regex", False),
+                tool_input.get("case_sensitive", False),
+                tool_input.get("context_lines", CODE_SEARCH_CONTEXT_LINES)
+            )
         elif tool_name == "list_files":
-            result = list_files(tool_input.get("path", "."))
+            result = await asyncio.to_thread(
+                list_files,
+                tool_input.get("path", "."),
+                tool_input.get("recursive", False),
+                tool_input.get("max_depth"),
+                tool_input.get("pattern")
+            )
         elif tool_name == "tavily_search":
-            result = tavily_search(tool_input["query"])
+            result = await tavily_search(tool_input["query"])
         else:
             is_error = True
             result = f"Unknown tool: {tool_name}"
 
+        if automode_run is not None and not is_error and not str(result).startswith("Error"):
+            try:
+                automode_run.record_tool(tool_name, tool_input, result, before)
+            except OSError as e:
+                logging.error(f"Error recording the completed tool call: {str(e)}")
+
         return {
             "content": result,
             "is_error": is_error
@@ -713,59 +2596,1137 @@ async def execute_tool(tool_call: Dict[str, Any]) -> Dict[str, Any]:
         }
 
 
+def get_tool_input(tool_call):
+    tool_arguments = tool_call['function']['arguments']
+    # Check if tool_arguments is a string and parse it if necessary
+    if isinstance(tool_arguments, str):
+        try:
+            return json.loads(tool_arguments)
+        except json.JSONDecodeError:
+            return None
+    return tool_arguments
+
+
+def get_tool_call_paths(tool_name, tool_input):
+    if not tool_input:
+        return set()
+    if tool_name == "read_multiple_files":
+        paths = tool_input.get("paths", [])
+    elif tool_name == "list_files":
+        paths = [tool_input.get("path", ".")]
+    elif "path" in tool_input:
+        paths = [tool_input["path"]]
+    else:
+        paths = []
+    return {os.path.abspath(path) for path in paths if isinstance(path, str)}
+
+
+def paths_overlap(paths_a, paths_b):
+    # Paths overlap if they are equal or one is inside the other (e.g. create_folder then create_file in it)
+    for a in paths_a:
+        for b in paths_b:
+            if a == b or a.startswith(b + os.sep) or b.startswith(a + os.sep):
+                return True
+    return False
+
+
+async def execute_tool_calls(tool_calls):
+    # Runs the tool calls of a single model turn concurrently. A call waits for every earlier call
+    # whose paths overlap with its own when either of them writes, so writes to the same path keep
+    # the order the model asked for. Results are returned in the original order.
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_TOOL_CALLS)
+    scheduled = []
+
+    async def run(tool_call, dependencies, paths, is_write):
+        if dependencies:
+            await asyncio.gather(*dependencies, return_exceptions=True)
+        async with semaphore:
+            # Writes also wait for goal agents running alongside this one that write the same paths
+            if goal_file_locks is None or not is_write:
+                return await execute_tool(tool_call)
+            held = await goal_file_locks.acquire(paths)
+            try:
+                return await execute_tool(tool_call)
+            finally:
+                goal_file_locks.release(held)
+
+    for tool_call in tool_calls:
+        tool_name = tool_call['function']['name']
+        paths = get_tool_call_paths(tool_name, get_tool_input(tool_call))
+        # Unknown tools and writes without a path are treated as barriers
+        is_barrier = tool_name not in PARALLEL_SAFE_TOOLS and not paths
+        is_write = tool_name not in PARALLEL_SAFE_TOOLS
+        dependencies = [
+            task for task, prev_paths, prev_write, prev_barrier in scheduled
+            if is_barrier or prev_barrier or ((is_write or prev_write) and paths_overlap(paths, prev_paths))
+        ]
+        task = asyncio.create_task(run(tool_call, dependencies, paths, is_write))
+        scheduled.append((task, paths, is_write, is_barrier))
+
+    return await asyncio.gather(*(task for task, _, _, _ in scheduled))
+
+
 def parse_goals(response):
     goals = re.findall(r'Goal \d+: (.+)', response)
     return goals
 
+class FileLockManager:
+    # asyncio locks by path, taken in sorted order so that agents locking several paths can't deadlock
+    def __init__(self):
+        self.locks = {}
+
+    async def acquire(self, paths):
+        held = []
+        try:
+            for path in sorted(paths):
+                lock = self.locks.setdefault(path, asyncio.Lock())
+                await lock.acquire()
+                held.append(lock)
+        except BaseException:
+            self.release(held)
+            raise
+        return held
+
+    def release(self, held):
+        for lock in reversed(held):
+            lock.release()
+
+
+def get_goal_paths(goal):
+    # File and directory names mentioned in a goal, compared by normalized path and by file name
+    paths = set()
+    for match in GOAL_PATH_PATTERN.findall(goal):
+        path = os.path.normpath(match.strip('./') or match).lower()
+        name = os.path.basename(path)
+        if '.' in name and len(name) < 4:
+            continue  # Abbreviations like "e.g." rather than files
+        paths.add(path)
+        if '.' in name:
+            paths.add(name)
+    return paths
+
+
+def build_goal_graph(goals):
+    # Returns the set of goals (by index) each goal depends on: the ones it names with "depends on
+    # Goal N" or "after Goal N", and the earlier goals that mention one of the same files. Only
+    # earlier goals count, so the graph has no cycles and goal order breaks the ties.
+    goal_paths = [get_goal_paths(goal) for goal in goals]
+    dependencies = []
+    for i, goal in enumerate(goals):
+        depends_on = set()
+        for numbers in GOAL_DEPENDENCY_PATTERN.findall(goal):
+            depends_on.update(int(number) - 1 for number in re.findall(r'\d+', numbers))
+        depends_on = {j for j in depends_on if 0 <= j < i}
+        depends_on.update(j for j in range(i) if goal_paths[i] & goal_paths[j])
+        dependencies.append(depends_on)
+    return dependencies
+
+
+def get_goal_ancestors(dependencies, i):
+    ancestors = set()
+    pending = list(dependencies[i])
+    while pending:
+        j = pending.pop()
+        if j not in ancestors:
+            ancestors.add(j)
+            pending.extend(dependencies[j])
+    return sorted(ancestors)
+
+
 async def execute_goals(goals):
-    global automode
-    for i, goal in enumerate(goals, 1):
-        console.print(Panel(f"Executing Goal {i}: {goal}", title="Goal Execution", style="bold yellow"))
-        response, _ = await chat_with_ollama(f"Continue working on goal: {goal}")
+    # Runs the goals as a DAG of agents, each starting once the goals it depends on are done, so
+    # independent goals run at the same time (up to MAX_PARALLEL_GOALS). Every agent works on its
+    # own copy of the history plus the turns of the goals it depends on, and writes to a path are
+    # serialized across agents by goal_file_locks. The turns are merged into conversation_history
+    # in goal order. Returns True if a goal reported the task complete.
+    global automode, conversation_history, goal_file_locks
+    if not goals:
+        return False
+    dependencies = build_goal_graph(goals)
+    plan = "\n".join(
+        f"Goal {i}: {goal}" + (f" (after {', '.join(f'Goal {j + 1}' for j in sorted(depends_on))})" if depends_on else "")
+        for i, (goal, depends_on) in enumerate(zip(goals, dependencies), 1)
+    )
+    console.print(Panel(plan, title="Goal Execution Plan", style="bold yellow"))
+
+    base_history = list(conversation_history)
+    turns = [None] * len(goals)
+    finished = False
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_GOALS)
+    tasks = []
+
+    async def run(i, goal):
+        nonlocal finished
+        if dependencies[i]:
+            await asyncio.gather(*(tasks[j] for j in dependencies[i]))
+        if finished:
+            return
+        history = base_history + [message for j in get_goal_ancestors(dependencies, i) for message in turns[j] or []]
+        async with semaphore:
+            console.print(Panel(f"Executing Goal {i + 1}: {goal}", title="Goal Execution", style="bold yellow"))
+            response, _, _, current_conversation = await run_model_turn(history, f"Continue working on goal: {goal}", label=f"Goal {i + 1}")
+        turns[i] = current_conversation
         if CONTINUATION_EXIT_PHRASE in response:
-            automode = False
-            console.print(Panel("Exiting automode.", title="Automode", style="bold green"))
-            break
+            finished = True
+
+    goal_file_locks = FileLockManager()
+    try:
+        tasks.extend(asyncio.create_task(run(i, goal)) for i, goal in enumerate(goals))
+        await asyncio.gather(*tasks)
+    finally:
+        goal_file_locks = None
+        merged = [message for turn in turns if turn for message in turn]
+        conversation_history = conversation_history + merged
+        save_session_state(conversation_history)
+        if automode_chat_log is not None and merged:
+            try:
+                automode_chat_log.append(merged)
+            except Exception as e:
+                logging.error(f"Error writing the automode chat log: {str(e)}")
+
+    if finished:
+        automode = False
+        console.print(Panel("Exiting automode.", title="Automode", style="bold green"))
+    return finished
 
 async def run_goals(response):
     goals = parse_goals(response)
     await execute_goals(goals)
 
 
-def save_chat():
-    # Generate filename
-    now = datetime.datetime.now()
-    filename = f"Chat_{now.strftime('%H%M')}.md"
-    
-    # Format conversation history
-    formatted_chat = "# Claude-3-Sonnet Engineer Chat Log\n\n"
-    for message in conversation_history:
-        if message['role'] == 'user':
-            formatted_chat += f"## User\n\n{message['content']}\n\n"
-        elif message['role'] == 'assistant':
-            if isinstance(message['content'], str):
-                formatted_chat += f"## Claude\n\n{message['content']}\n\n"
-            elif isinstance(message['content'], list):
-                for content in message['content']:
-                    if content['type'] == 'tool_use':
-                        formatted_chat += f"### Tool Use: {content['name']}\n\n```json\n{json.dumps(content['input'], indent=2)}\n```\n\n"
-                    elif content['type'] == 'text':
-                        formatted_chat += f"## Claude\n\n{content['text']}\n\n"
-        elif message['role'] == 'user' and isinstance(message['content'], list):
-            for content in message['content']:
-                if content['type'] == 'tool_result':
-                    formatted_chat += f"### Tool Result\n\n```\n{content['content']}\n```\n\n"
-    
-    # Save to file
-    with open(filename, 'w', encoding='utf-8') as f:
-        f.write(formatted_chat)
-    
-    return filename
+class BlobStore:
+    # Text stored once by content hash, as <directory>/<hash[:2]>/<hash>. Shared by the session log
+    # and the automode checkpoints, which both keep long tool outputs out of their JSON.
+    def __init__(self, directory=os.path.join(SESSION_DIR, "blobs")):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, text):
+        digest = hashlib.sha256(text.encode('utf-8')).hexdigest()
+        path = self.path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            with open(temporary_path, 'w', encoding='utf-8') as f:
+                f.write(text)
+            os.replace(temporary_path, path)
+        return digest
+
+    def get(self, digest):
+        with open(self.path(digest), 'r', encoding='utf-8') as f:
+            return f.read()
+
+    def encode_message(self, message):
+        content = message.get("content")
+        if message.get("role") == "tool" and isinstance(content, str) and len(content) >= SESSION_BLOB_MIN_CHARS:
+            return {**message, "content": None, "content_blob": self.put(content)}
+        return message
+
+    def decode_message(self, message):
+        if "content_blob" in message:
+            message = dict(message)
+            message["content"] = self.get(message.pop("content_blob"))
+        return message
+
+
+class SessionStore:
+    # Append-only log of a session in SESSION_DIR/<id>.jsonl, one event per line, written as the
+    # conversation happens: new messages, file_contents references (path and hash, the content is
+    # re-read from disk on resume) and code editor memory entries. Tool outputs and editor
+    # responses are stored once by content hash under SESSION_DIR/blobs. When the history is
+    # rewritten (compaction) or every SESSION_CHECKPOINT_EVENTS events, a checkpoint with the
+    # whole state is appended and its offset saved in <id>.index.json, so resuming reads only
+    # the last checkpoint and the events after it, however long the session.
+    def __init__(self, session_id=None, directory=SESSION_DIR):
+        self.directory = directory
+        self.session_id = session_id or f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+        self.path = os.path.join(directory, f"{self.session_id}.jsonl")
+        self.index_path = os.path.join(directory, f"{self.session_id}.index.json")
+        self.file = None
+        self.logged_history = []
+        self.logged_files = {}
+        self.events_since_checkpoint = 0
+        self.lock = threading.Lock()
+        self.blobs = BlobStore(os.path.join(directory, "blobs"))
+
+    def write(self, event):
+        with self.lock:
+            if self.file is None:
+                os.makedirs(self.directory, exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+            offset = self.file.tell()
+            self.file.write(json.dumps(event, default=str) + "\n")
+            self.file.flush()
+            if SESSION_FSYNC:
+                os.fsync(self.file.fileno())
+            self.events_since_checkpoint += 1
+            return offset
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+    @staticmethod
+    def file_references():
+        return {path: [stats[2], path in partial_file_views] for path, stats in list(file_contents.file_stats.items())}
+
+    def sync(self, history):
+        # Logs the messages added since the last sync, or a checkpoint if earlier ones changed
+        logged = self.logged_history
+        if len(history) < len(logged) or not all(a is b or a == b for a, b in zip(logged, history)):
+            self.checkpoint(history)
+            return
+        for message in history[len(logged):]:
+            self.write({"type": "message", "message": self.blobs.encode_message(message)})
+        self.logged_history = list(history)
+
+        references = self.file_references()
+        for path, reference in references.items():
+            if self.logged_files.get(path) != reference:
+                self.write({"type": "file", "path": path, "digest": reference[0], "partial": reference[1]})
+        for path in self.logged_files.keys() - references.keys():
+            self.write({"type": "file_removed", "path": path})
+        self.logged_files = references
+
+        if self.events_since_checkpoint >= SESSION_CHECKPOINT_EVENTS:
+            self.checkpoint(history)
+
+    def log_editor_memory(self, path, instructions, response_text):
+        self.write({"type": "editor_memory", "path": path, "instructions": instructions, "response_blob": self.blobs.put(response_text)})
+
+    def checkpoint(self, history):
+        references = self.file_references()
+        offset = self.write({
+            "type": "checkpoint",
+            "time": time.time(),
+            "history": [self.blobs.encode_message(message) for message in history],
+            "files": references,
+            "editor_memory": code_editor_memory.snapshot()
+        })
+        temporary_path = f"{self.index_path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump({"checkpoint_offset": offset}, f)
+        os.replace(temporary_path, self.index_path)
+        self.logged_history = list(history)
+        self.logged_files = references
+        self.events_since_checkpoint = 0
+
+    def load(self):
+        # Returns (history, file references, editor memory snapshot, editor memory entries since it)
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                offset = json.load(f)["checkpoint_offset"]
+        except (OSError, ValueError, KeyError):
+            offset = 0
+        history = []
+        references = {}
+        editor_snapshot = []
+        editor_entries = []
+        with open(self.path, 'rb') as f:
+            f.seek(offset)
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    break  # A write cut short by a crash
+                if event["type"] == "checkpoint":
+                    history = list(event["history"])
+                    references = dict(event["files"])
+                    editor_snapshot = event["editor_memory"]
+                    editor_entries = []
+                elif event["type"] == "message":
+                    history.append(event["message"])
+                elif event["type"] == "file":
+                    references[event["path"]] = [event["digest"], event["partial"]]
+                elif event["type"] == "file_removed":
+                    references.pop(event["path"], None)
+                elif event["type"] == "editor_memory":
+                    editor_entries.append((event["path"], event["instructions"], event["response_blob"]))
+        history = [self.blobs.decode_message(message) for message in history]
+        editor_entries = [(path, instructions, self.blobs.get(digest)) for path, instructions, digest in editor_entries]
+        return history, references, editor_snapshot, editor_entries
+
+
+def save_session_state(history):
+    # Persistence is best effort, a failing disk shouldn't end the conversation
+    if session_store is None:
+        return
+    try:
+        session_store.sync(history)
+    except Exception as e:
+        logging.error(f"Error saving the session: {str(e)}")
+
+
+def find_latest_session(exclude=None):
+    try:
+        logs = [name for name in os.listdir(SESSION_DIR) if name.endswith(".jsonl") and name != f"{exclude}.jsonl"]
+    except OSError:
+        return None
+    if not logs:
+        return None
+    latest = max(logs, key=lambda name: os.path.getmtime(os.path.join(SESSION_DIR, name)))
+    return latest[:-len(".jsonl")]
+
+
+def restore_conversation(history, references, editor_snapshot, editor_entries=()):
+    # Replaces the conversation with a saved one. File contents are referenced by hash, they are
+    # reloaded from disk and the (changed, missing) files since the state was saved are returned.
+    global conversation_history, conversation_tokens
+    reset_conversation(quiet=True)
+    conversation_history = history
+    conversation_tokens = sum(message_tokens(message) for message in history)
+    code_editor_memory.restore(editor_snapshot)
+    for path, instructions, response_text in editor_entries:
+        code_editor_memory.add(path, instructions, response_text)
+
+    changed = []
+    missing = []
+    for key, (digest, partial) in references.items():
+        range_match = re.match(r'^(.*) \(lines (\d+)-(\d+|end)\)$', key)
+        path = range_match.group(1) if range_match else key
+        if not os.path.exists(path):
+            missing.append(key)
+            continue
+        if range_match:
+            end_line = None if range_match.group(3) == "end" else int(range_match.group(3))
+            load_file_into_context(path, int(range_match.group(2)), end_line)
+        else:
+            load_file_into_context(path)
+        stats = file_contents.file_stats.get(key)
+        if stats and stats[2] != digest and not partial:
+            changed.append(key)
+    return changed, missing
+
+
+def describe_file_changes(changed, missing):
+    summary = ""
+    if changed:
+        summary += f"\nChanged on disk since it was saved: {', '.join(changed)}"
+    if missing:
+        summary += f"\nNo longer on disk: {', '.join(missing)}"
+    return summary
+
+
+def resume_session(session_id=None):
+    global session_store
+    session_id = session_id or find_latest_session(exclude=session_store.session_id if session_store else None)
+    if not session_id or not os.path.exists(os.path.join(SESSION_DIR, f"{session_id}.jsonl")):
+        return f"No saved session{' ' + session_id if session_id else ''} found in {SESSION_DIR}."
+
+    store = SessionStore(session_id)
+    history, references, editor_snapshot, editor_entries = store.load()
+    changed, missing = restore_conversation(history, references, editor_snapshot, editor_entries)
+
+    if session_store is not None:
+        session_store.close()
+    session_store = store
+    session_store.logged_history = list(conversation_history)
+    session_store.logged_files = SessionStore.file_references()
+
+    summary = f"Resumed session {session_id}: {len(history)} messages, {len(references)} files in context, {len(code_editor_memory)} code editor memory entries."
+    return summary + describe_file_changes(changed, missing)
+
+
+class AutomodeRun:
+    # Checkpoint of an automode run, rewritten in AUTOMODE_CHECKPOINT_DIR/<id>.json after every
+    # iteration: the iteration count, the next prompt, the goals last parsed from the model's
+    # response, the history (long tool outputs go to the session blob store) and the hash of every
+    # file in context. Calls to the tools in AUTOMODE_REPLAYABLE_TOOLS are appended to
+    # <id>.tools.jsonl as they complete, with the hashes of the paths they wrote before and after,
+    # so that once the run is resumed a call the model repeats with the same arguments (for
+    # edit_and_apply that includes the instructions) is answered from the log instead of being run
+    # again, as long as those paths are still as that call or a later one of the run left them and
+    # haven't been reverted to how the call found them.
+    def __init__(self, goal, max_iterations, run_id=None):
+        self.run_id = run_id or f"{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}-{os.urandom(3).hex()}"
+        self.goal = goal
+        self.max_iterations = max_iterations
+        self.iteration = 0
+        self.next_input = goal
+        self.goals = []
+        self.status = "running"
+        self.resumed = False
+        self.completed_tools = {}
+        self.tool_records = []
+        self.path = os.path.join(AUTOMODE_CHECKPOINT_DIR, f"{self.run_id}.json")
+        self.tools_path = os.path.join(AUTOMODE_CHECKPOINT_DIR, f"{self.run_id}.tools.jsonl")
+        self.blobs = BlobStore()
+
+    @staticmethod
+    def tool_key(tool_name, tool_input):
+        return hashlib.sha256(json.dumps([tool_name, tool_input], sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def path_digest(path):
+        if os.path.isdir(path):
+            return "directory"
+        try:
+            with open(path, 'rb') as f:
+                return hashlib.sha256(f.read()).hexdigest()
+        except OSError:
+            return None
+
+    def path_digests(self, tool_name, tool_input):
+        # Hashes of the paths a replayable call writes, taken before it runs and after it completes
+        if tool_name not in AUTOMODE_REPLAYABLE_TOOLS:
+            return None
+        return {path: self.path_digest(path) for path in get_tool_call_paths(tool_name, tool_input)}
+
+    def record_tool(self, tool_name, tool_input, result, before):
+        if tool_name not in AUTOMODE_REPLAYABLE_TOOLS:
+            return
+        record = {
+            "key": self.tool_key(tool_name, tool_input),
+            "seq": len(self.tool_records),
+            "tool": tool_name,
+            "before": before or {},
+            "paths": self.path_digests(tool_name, tool_input),
+            "result": result
+        }
+        self.add_tool_record(record)
+        os.makedirs(AUTOMODE_CHECKPOINT_DIR, exist_ok=True)
+        with open(self.tools_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(record, default=str) + "\n")
+            f.flush()
+            if SESSION_FSYNC:
+                os.fsync(f.fileno())
+
+    def add_tool_record(self, record):
+        self.completed_tools[record["key"]] = record
+        self.tool_records.append(record)
+
+    def completed_result(self, tool_name, tool_input):
+        # The result of the same call completed before the run was resumed, if it's safe to reuse
+        if not self.resumed:
+            return None
+        record = self.completed_tools.get(self.tool_key(tool_name, tool_input))
+        if record is None:
+            return None
+        later_records = self.tool_records[record["seq"] + 1:]
+        for path, digest in record["paths"].items():
+            current = self.path_digest(path)
+            if current is None:
+                return None
+            # Back to how the call found it (a revert), so its effect is gone and it has to run again
+            before = record.get("before", {}).get(path)
+            if current == before and before != digest:
+                return None
+            if current != digest and all(later.get("paths", {}).get(path) != current for later in later_records):
+                return None
+        return record["result"]
+
+    def checkpoint(self):
+        state = {
+            "run_id": self.run_id,
+            "goal": self.goal,
+            "max_iterations": self.max_iterations,
+            "iteration": self.iteration,
+            "next_input": self.next_input,
+            "goals": self.goals,
+            "status": self.status,
+            "time": time.time(),
+            "session_id": session_store.session_id if session_store else None,
+            "history": [self.blobs.encode_message(message) for message in conversation_history],
+            "files": SessionStore.file_references(),
+            "editor_memory": code_editor_memory.snapshot()
+        }
+        os.makedirs(AUTOMODE_CHECKPOINT_DIR, exist_ok=True)
+        temporary_path = f"{self.path}.tmp"
+        with open(temporary_path, 'w', encoding='utf-8') as f:
+            json.dump(state, f, default=str)
+            f.flush()
+            if SESSION_FSYNC:
+                os.fsync(f.fileno())
+        os.replace(temporary_path, self.path)
+
+    @classmethod
+    def load(cls, run_id):
+        # Returns (run, history, file references, editor memory snapshot)
+        with open(os.path.join(AUTOMODE_CHECKPOINT_DIR, f"{run_id}.json"), 'r', encoding='utf-8') as f:
+            state = json.load(f)
+        run = cls(state["goal"], state["max_iterations"], run_id)
+        run.iteration = state["iteration"]
+        run.next_input = state["next_input"]
+        run.goals = state["goals"]
+        run.status = state["status"]
+        try:
+            with open(run.tools_path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break  # A write cut short by a crash
+                    record["seq"] = len(run.tool_records)
+                    run.add_tool_record(record)
+        except OSError:
+            pass
+        history = [run.blobs.decode_message(message) for message in state["history"]]
+        return run, history, state["files"], state["editor_memory"]
+
+
+def save_automode_checkpoint(run):
+    # Like the session log, a failing checkpoint shouldn't end the run
+    try:
+        run.checkpoint()
+    except Exception as e:
+        logging.error(f"Error saving the automode checkpoint: {str(e)}")
+
+
+def find_latest_automode_run():
+    # The most recently checkpointed run that didn't finish
+    try:
+        names = [name for name in os.listdir(AUTOMODE_CHECKPOINT_DIR) if name.endswith(".json")]
+    except OSError:
+        return None
+    for name in sorted(names, key=lambda name: os.path.getmtime(os.path.join(AUTOMODE_CHECKPOINT_DIR, name)), reverse=True):
+        try:
+            with open(os.path.join(AUTOMODE_CHECKPOINT_DIR, name), 'r', encoding='utf-8') as f:
+                if json.load(f).get("status") == "running":
+                    return name[:-len(".json")]
+        except (OSError, ValueError):
+            continue
+    return None
+
+
+def resume_automode(run_id=None):
+    # Returns (run, summary), run is None if there is nothing to resume
+    run_id = run_id or find_latest_automode_run()
+    if not run_id or not os.path.exists(os.path.join(AUTOMODE_CHECKPOINT_DIR, f"{run_id}.json")):
+        return None, f"No unfinished automode run{' ' + run_id if run_id else ''} found in {AUTOMODE_CHECKPOINT_DIR}."
+
+    run, history, references, editor_snapshot = AutomodeRun.load(run_id)
+    if run.status != "running":
+        return None, f"Automode run {run_id} already finished ({run.status})."
+    changed, missing = restore_conversation(history, references, editor_snapshot)
+    run.resumed = True
+
+    summary = f"Resuming automode run {run_id} at iteration {run.iteration + 1} of {run.max_iterations}: {len(history)} messages, {len(references)} files in context, {len(run.completed_tools)} completed tool calls on record."
+    if run.goals:
+        summary += "\nGoals:\n" + "\n".join(f"Goal {i}: {goal}" for i, goal in enumerate(run.goals, 1))
+    return run, summary + describe_file_changes(changed, missing)
+
+def iter_chat_markdown(messages):
+    # Yields the Markdown log of messages piece by piece, large tool results are yielded as they are
+    for message in messages:
+        role = message['role']
+        content = message.get('content')
+        if role == 'user' and isinstance(content, list):
+            for block in content:
+                if block.get('type') == 'tool_result':
+                    yield "### Tool Result\n\n```\n"
+                    yield str(block.get('content', ''))
+                    yield "\n```\n\n"
+        elif role == 'user':
+            yield f"## User\n\n{content}\n\n"
+        elif role == 'assistant':
+            if isinstance(content, list):
+                for block in content:
+                    if block.get('type') == 'tool_use':
+                        yield f"### Tool Use: {block['name']}\n\n```json\n{json.dumps(block['input'], indent=2)}\n```\n\n"
+                    elif block.get('type') == 'text':
+                        yield f"## Claude\n\n{block['text']}\n\n"
+            elif content:
+                yield f"## Claude\n\n{content}\n\n"
+            for tool_call in message.get('tool_calls') or []:
+                yield f"### Tool Use: {tool_call['function']['name']}\n\n```json\n{json.dumps(get_tool_input(tool_call), indent=2)}\n```\n\n"
+        elif role == 'tool':
+            yield "### Tool Result\n\n```\n"
+            yield str(content)
+            yield "\n```\n\n"
+        elif role == 'system' and content:
+            yield f"## Summary\n\n{content}\n\n"
+
+def iter_chat_json(messages):
+    # JSON Lines, one message per line, so a log can be appended to and read back while it grows
+    for message in messages:
+        yield json.dumps(message, default=str) + "\n"
+
+CHAT_EXPORT_FORMATS = {
+    "md": (".md", "# Claude-3-Sonnet Engineer Chat Log\n\n", iter_chat_markdown),
+    "json": (".jsonl", "", iter_chat_json),
+}
+
+def write_chunks(f, pieces):
+    # Buffers small pieces into CHAT_EXPORT_CHUNK_CHARS writes, large ones are written straight through
+    buffer = []
+    size = 0
+    for piece in pieces:
+        if len(piece) >= CHAT_EXPORT_CHUNK_CHARS:
+            if buffer:
+                f.write("".join(buffer))
+                buffer.clear()
+                size = 0
+            f.write(piece)
+            continue
+        buffer.append(piece)
+        size += len(piece)
+        if size >= CHAT_EXPORT_CHUNK_CHARS:
+            f.write("".join(buffer))
+            buffer.clear()
+            size = 0
+    if buffer:
+        f.write("".join(buffer))
+
+def open_chat_file(prefix, extension):
+    # Second-resolution names, and a numeric suffix rather than overwriting an existing log
+    stamp = datetime.datetime.now().strftime('%Y%m%d_%H%M%S')
+    for attempt in itertools.count(1):
+        filename = f"{prefix}_{stamp}{'' if attempt == 1 else f'_{attempt}'}{extension}"
+        try:
+            return filename, open(filename, 'x', encoding='utf-8')
+        except FileExistsError:
+            continue
+
+
+class ChatLog:
+    # A chat log written incrementally, e.g. after every automode iteration, instead of in one go
+    def __init__(self, format="md", prefix="Chat"):
+        extension, header, self.render = CHAT_EXPORT_FORMATS[format]
+        self.filename, self.file = open_chat_file(prefix, extension)
+        self.file.write(header)
+        self.file.flush()
+
+    def append(self, messages):
+        write_chunks(self.file, self.render(messages))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def save_chat(format="md"):
+    chat_log = ChatLog(format)
+    try:
+        chat_log.append(conversation_history)
+    finally:
+        chat_log.close()
+    return chat_log.filename
+
+
+
+def estimate_tokens(text):
+    return (len(text) + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN if text else 0
+
+def message_tokens(message):
+    content = message.get('content')
+    tokens = estimate_tokens(content if isinstance(content, str) else json.dumps(content, default=str))
+    if message.get('tool_calls'):
+        tokens += estimate_tokens(json.dumps(message['tool_calls'], default=str))
+    return tokens + 4  # Per-message formatting overhead
+
+def summarize_message(message):
+    content = message.get('content')
+    if message['role'] not in ('user', 'assistant') or not isinstance(content, str) or not content.strip():
+        return None
+    first_line = content.strip().splitlines()[0]
+    if len(first_line) > 150:
+        first_line = first_line[:150] + "..."
+    return f"- {message['role'].capitalize()}: {first_line}"
+
+def compact_conversation_history(history, budget=CONVERSATION_TOKEN_BUDGET):
+    # Keeps the estimated size of the history under budget. Stale tool results are removed first,
+    # then the oldest turns are dropped and replaced by a short summary system message.
+    counts = [message_tokens(message) for message in history]
+    total = sum(counts)
+    report = {'tokens_before': total, 'tokens_after': total, 'dropped_messages': 0, 'truncated_tool_results': 0}
+    if total <= budget:
+        return history, report
+
+    history = list(history)
+    turn_starts = [i for i, message in enumerate(history) if message['role'] == 'user']
+
+    # 1. Replace tool results from older turns with a stub
+    stale_before = turn_starts[-STALE_TOOL_RESULT_TURNS] if len(turn_starts) >= STALE_TOOL_RESULT_TURNS else 0
+    for i in range(stale_before):
+        if total <= budget:
+            break
+        if history[i]['role'] == 'tool' and counts[i] > 50:
+            stub = {**history[i], 'content': f"[Tool result removed to save context: ~{counts[i]} tokens]"}
+            stub_tokens = message_tokens(stub)
+            total -= counts[i] - stub_tokens
+            counts[i] = stub_tokens
+            history[i] = stub
+            report['truncated_tool_results'] += 1
+
+    # 2. Drop whole turns from the front, never touching the most recent ones
+    summary_lines = []
+    start = 0
+    if history and history[0]['role'] == 'system':
+        summary_lines = history[0]['content'].splitlines()[1:]
+        total -= counts[0]
+        start = 1
+    protected = turn_starts[-KEEP_RECENT_TURNS] if len(turn_starts) >= KEEP_RECENT_TURNS else (turn_starts[0] if turn_starts else len(history))
+    cut = start
+    for boundary in [i for i in turn_starts if start < i <= protected] + [protected]:
+        if total <= budget:
+            break
+        for message in history[cut:boundary]:
+            line = summarize_message(message)
+            if line:
+                summary_lines.append(line)
+        total -= sum(counts[cut:boundary])
+        report['dropped_messages'] += boundary - cut
+        cut = boundary
+
+    if report['dropped_messages'] or start:
+        summary = {
+            "role": "system",
+            "content": "Summary of earlier conversation (older turns were removed to stay within the context budget):\n" + "\n".join(summary_lines[-MAX_SUMMARY_LINES:])
+        }
+        total += message_tokens(summary)
+        history = [summary] + history[cut:]
+
+    report['tokens_after'] = total
+    return history, report
+
+def report_compaction(report):
+    if report['dropped_messages'] or report['truncated_tool_results']:
+        console.print(Panel(
+            f"Dropped {report['dropped_messages']} old message(s) and removed {report['truncated_tool_results']} stale tool result(s).\n"
+            f"Estimated history size: {report['tokens_before']} -> {report['tokens_after']} tokens (budget {CONVERSATION_TOKEN_BUDGET}).",
+            title="Context Compacted", style="yellow"
+        ))
+
+
+class ChatProvider(ABC):
+    # A model backend. chat() takes Ollama-style messages and tools and returns
+    # {"content", "tool_calls", "usage": {"input_tokens", "output_tokens"}}, with tool calls in
+    # Ollama's {"id", "function": {"name", "arguments"}} shape whatever the backend.
+    # on_text, when given, is called with each piece of text as it streams in.
+    name = None
+
+    @abstractmethod
+    async def chat(self, model, messages, tools=None, on_text=None):
+        ...
+
+    def is_retryable(self, error):
+        if isinstance(error, (asyncio.TimeoutError, ConnectionError, httpx.TransportError)):
+            return True
+        return getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES
+
+    async def close(self):
+        pass
+
+
+class OllamaProvider(ChatProvider):
+    name = "ollama"
+
+    def __init__(self):
+        # One client per provider, so every role shares its connection pool
+        self.client = ollama.AsyncClient(
+            timeout=PROVIDER_TIMEOUT,
+            limits=httpx.Limits(max_connections=PROVIDER_MAX_CONNECTIONS)
+        )
+
+    @staticmethod
+    def plain_tool_calls(tool_calls):
+        return [tool_call.model_dump(exclude_none=True) if hasattr(tool_call, 'model_dump') else tool_call for tool_call in tool_calls or []]
+
+    @staticmethod
+    def usage(response):
+        return {"input_tokens": response.get('prompt_eval_count') or 0, "output_tokens": response.get('eval_count') or 0}
+
+    async def chat(self, model, messages, tools=None, on_text=None):
+        request = {"model": model, "messages": messages, "keep_alive": OLLAMA_KEEP_ALIVE}
+        if tools:
+            request["tools"] = tools
+        if on_text is None:
+            response = await self.client.chat(stream=False, **request)
+            message = response['message']
+            return {
+                "content": message.get('content') or '',
+                "tool_calls": self.plain_tool_calls(message.get('tool_calls')),
+                "usage": self.usage(response)
+            }
+
+        response_parts = []
+        tool_calls = []
+        final_chunk = {}
+        async for chunk in await self.client.chat(stream=True, **request):
+            if 'error' in chunk:
+                raise RuntimeError(chunk['error'])
+            message = chunk.get('message') or {}
+            content = message.get('content') or ''
+            tool_calls.extend(self.plain_tool_calls(message.get('tool_calls')))
+            if content:
+                response_parts.append(content)
+                on_text(content)
+            if chunk.get('done'):
+                final_chunk = chunk
+        return {"content": "".join(response_parts), "tool_calls": tool_calls, "usage": self.usage(final_chunk)}
+
+    async def close(self):
+        close = getattr(self.client, "close", None)
+        if close is not None:
+            await close()
+
+
+class AnthropicProvider(ChatProvider):
+    name = "anthropic"
+
+    def __init__(self):
+        if anthropic is None:
+            raise RuntimeError("The anthropic package is required for the anthropic provider")
+        # Retries are handled by call_model for every provider alike. The SDK keeps its own
+        # connection pool, shared by every role through this one client.
+        self.client = anthropic.AsyncAnthropic(max_retries=0, timeout=PROVIDER_TIMEOUT)
+
+    def is_retryable(self, error):
+        if isinstance(error, (anthropic.APIConnectionError, anthropic.APITimeoutError)):
+            return True
+        return super().is_retryable(error)
+
+    @staticmethod
+    def build_request(model, messages, tools):
+        # System messages become the system prompt, tool results become user tool_result blocks,
+        # and consecutive messages of one role are merged since Anthropic requires alternating roles
+        system_parts = []
+        converted = []
+        for message in messages:
+            role = message["role"]
+            content = message.get("content")
+            if role == "system":
+                system_parts.append(content)
+                continue
+            blocks = []
+            if role == "tool":
+                role = "user"
+                blocks.append({"type": "tool_result", "tool_use_id": message.get("tool_call_id", "unknown_id"), "content": str(content)})
+            elif content:
+                blocks.append({"type": "text", "text": content if isinstance(content, str) else json.dumps(content)})
+            for i, tool_call in enumerate(message.get("tool_calls") or []):
+                blocks.append({
+                    "type": "tool_use",
+                    "id": tool_call.get("id", f"tool_{i}"),
+                    "name": tool_call["function"]["name"],
+                    "input": get_tool_input(tool_call) or {}
+                })
+            if not blocks:
+                continue
+            if converted and converted[-1]["role"] == role:
+                converted[-1]["content"].extend(blocks)
+            else:
+                converted.append({"role": role, "content": blocks})
+
+        request = {"model": model, "max_tokens": PROVIDER_MAX_TOKENS, "messages": converted}
+        if system_parts:
+            request["system"] = "\n\n".join(system_parts)
+        if tools:
+            request["tools"] = [
+                {"name": tool["function"]["name"], "description": tool["function"].get("description", ""), "input_schema": tool["function"]["parameters"]}
+                for tool in tools
+            ]
+        return request
+
+    async def chat(self, model, messages, tools=None, on_text=None):
+        request = self.build_request(model, messages, tools)
+        if on_text is None:
+            response = await self.client.messages.create(**request)
+        else:
+            async with self.client.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    on_text(text)
+                response = await stream.get_final_message()
+        return {
+            "content": "".join(block.text for block in response.content if block.type == "text"),
+            "tool_calls": [
+                {"id": block.id, "function": {"name": block.name, "arguments": block.input}}
+                for block in response.content if block.type == "tool_use"
+            ],
+            "usage": {"input_tokens": response.usage.input_tokens, "output_tokens": response.usage.output_tokens}
+        }
+
+    async def close(self):
+        await self.client.close()
+
+
+class MockProvider(ChatProvider):
+    # Offline provider for tests and dry runs. Replies are taken from a queue of scripted responses
+    # (strings, result dicts, or exceptions to raise); once it is empty the last user message is echoed.
+    name = "mock"
+
+    def __init__(self, responses=None):
+        self.responses = deque(responses or [])
+        self.calls = []
+
+    async def chat(self, model, messages, tools=None, on_text=None):
+        self.calls.append({"model": model, "messages": messages, "tools": tools})
+        if self.responses:
+            reply = self.responses.popleft()
+        else:
+            last_user = next((message.get("content") for message in reversed(messages) if message["role"] == "user"), "")
+            reply = f"Mock response to: {last_user}"
+        if isinstance(reply, Exception):
+            raise reply
+        if isinstance(reply, str):
+            reply = {"content": reply}
+        content = reply.get("content", "")
+        if on_text is not None:
+            for word in re.findall(r'\S+\s*', content):
+                on_text(word)
+        return {
+            "content": content,
+            "tool_calls": reply.get("tool_calls", []),
+            "usage": {
+                "input_tokens": sum(message_tokens(message) for message in messages),
+                "output_tokens": estimate_tokens(content)
+            }
+        }
+
+
+PROVIDER_CLASSES = {"ollama": OllamaProvider, "anthropic": AnthropicProvider, "mock": MockProvider}
 
 
+def get_provider(name):
+    # Providers are created on first use and shared by every role that uses them
+    if name not in providers:
+        if name not in PROVIDER_CLASSES:
+            raise ValueError(f"Unknown model provider '{name}', expected one of {', '.join(PROVIDER_CLASSES)}")
+        providers[name] = PROVIDER_CLASSES[name]()
+    return providers[name]
 
-async def chat_with_ollama(user_input, image_path=None, current_iteration=None, max_iterations=None):
-    global conversation_history, automode, main_model_tokens
+
+async def close_providers():
+    for provider in list(providers.values()):
+        try:
+            await provider.close()
+        except Exception as e:
+            logging.error(f"Error closing the {provider.name} provider: {str(e)}")
+    providers.clear()
+
+
+def record_usage(role, provider_name, model, usage, latency, time_to_first_token, attempts):
+    totals = role_token_totals.setdefault(role, {"calls": 0, "input_tokens": 0, "output_tokens": 0, "latency": 0.0})
+    totals["calls"] += 1
+    totals["input_tokens"] += usage["input_tokens"]
+    totals["output_tokens"] += usage["output_tokens"]
+    totals["latency"] += latency
+    usage_records.append({
+        "timestamp": time.time(),
+        "role": role,
+        "provider": provider_name,
+        "model": model,
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"],
+        "latency": latency,
+        "time_to_first_token": time_to_first_token,
+        "attempts": attempts
+    })
+    while len(usage_records) > USAGE_RECORD_LIMIT:
+        usage_records.popleft()
+
+
+async def call_model(role, messages, tools=None, on_text=None):
+    # Every model call goes through here: the role picks the provider and model, transient errors
+    # are retried with exponential backoff and jitter, and usage and latency are recorded.
+    # A stream that already produced text isn't retried, its output has been shown.
+    provider_name, model = ROLE_MODELS[role]
+    provider = get_provider(provider_name)
+    for attempt in range(1, PROVIDER_MAX_RETRIES + 2):
+        start_time = time.time()
+        first_token_time = None
+
+        def on_piece(text):
+            nonlocal first_token_time
+            if first_token_time is None:
+                first_token_time = time.time()
+            on_text(text)
+
+        try:
+            result = await asyncio.wait_for(
+                provider.chat(model, messages, tools, on_piece if on_text is not None else None),
+                PROVIDER_REQUEST_TIMEOUT
+            )
+        except Exception as e:
+            if attempt > PROVIDER_MAX_RETRIES or first_token_time is not None or not provider.is_retryable(e):
+                raise
+            delay = PROVIDER_BACKOFF_BASE * 2 ** (attempt - 1) * random.uniform(0.5, 1.0)
+            console.print(f"{role} call to {provider_name} failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s", style="yellow")
+            await asyncio.sleep(delay)
+            continue
+
+        latency = time.time() - start_time
+        time_to_first_token = first_token_time - start_time if first_token_time is not None else None
+        record_usage(role, provider_name, model, result["usage"], latency, time_to_first_token, attempt)
+        timing = f"Time to first token: {time_to_first_token:.2f}s | " if time_to_first_token is not None else ""
+        console.print(
+            f"{timing}Total: {latency:.2f}s | {result['usage']['input_tokens']} input / {result['usage']['output_tokens']} output tokens ({role}, {model})",
+            style="dim"
+        )
+        return result
+
+
+async def stream_model_chat(role, messages, title):
+    # Streams a chat completion through call_model, rendering text as it arrives
+    response_parts = []
+    last_render_time = 0.0
+
+    def render(subtitle=None):
+        return Panel(Markdown("".join(response_parts)), title=title, title_align="left", subtitle=subtitle, border_style="blue", expand=False)
+
+    with Live(render(), console=console, refresh_per_second=STREAM_REFRESH_PER_SECOND) as live:
+        def on_text(text):
+            nonlocal last_render_time
+            response_parts.append(text)
+            # Re-rendering Markdown is linear in the response length, so throttle it to the refresh rate
+            now = time.time()
+            if now - last_render_time >= 1 / STREAM_REFRESH_PER_SECOND:
+                live.update(render())
+                last_render_time = now
+
+        result = await call_model(role, messages, tools, on_text=on_text)
+        live.update(render(f"{len(result['tool_calls'])} tool call(s)" if result["tool_calls"] else None))
+    return result
+
+
+def display_token_usage():
+    if not role_token_totals:
+        return
+    lines = []
+    for role, totals in role_token_totals.items():
+        lines.append(
+            f"{role}: {totals['calls']} calls, {totals['input_tokens']} input / {totals['output_tokens']} output tokens, "
+            f"{totals['latency'] / totals['calls']:.2f}s average latency"
+        )
+    console.print(Panel("\n".join(lines), title="Token Usage", title_align="left", style="cyan", expand=False))
+
+
+async def chat_with_ollama(user_input, image_path=None, current_iteration=None, max_iterations=None, defer_goals=False):
+    global conversation_history, conversation_tokens
+
+    conversation_history, compaction = compact_conversation_history(conversation_history)
+    conversation_tokens = compaction['tokens_after']
+    report_compaction(compaction)
+
+    assistant_response, exit_continuation, messages, current_conversation = await run_model_turn(
+        conversation_history, user_input, current_iteration, max_iterations, defer_goals=defer_goals)
+    if messages is None:
+        return assistant_response, False
+
+    conversation_history = messages + [{"role": "assistant", "content": assistant_response}]
+    save_session_state(conversation_history)
+    if automode_chat_log is not None:
+        try:
+            automode_chat_log.append(current_conversation)
+        except Exception as e:
+            logging.error(f"Error writing the automode chat log: {str(e)}")
+
+    return assistant_response, exit_continuation
+
+async def run_model_turn(history, user_input, current_iteration=None, max_iterations=None, label=None, defer_goals=False):
+    # One MAINMODEL turn on top of history: the response, its tool calls and the TOOLCHECKERMODEL
+    # review of their results. Returns (response, exit_continuation, messages, current_conversation),
+    # messages being None if the model call failed. A label marks the output of a goal agent running
+    # alongside others, those turns aren't streamed (rich allows one Live display at a time) and
+    # their isolated histories aren't saved to the session log. With defer_goals, a response that
+    # sets several goals doesn't run its tool calls, the goal agents of execute_goals do that work.
+    stream = STREAM_RESPONSES and label is None
+    prefix = f"[{label}] " if label else ""
+    save_state = save_session_state if label is None else (lambda messages: None)
 
     # This function uses MAINMODEL, which maintains context across calls
     current_conversation = []
@@ -774,7 +3735,7 @@ async def chat_with_ollama(user_input, image_path=None, current_iteration=None,
 
     # Filter conversation history to maintain context
     filtered_conversation_history = []
-    for message in conversation_history:
+    for message in history:
         if isinstance(message['content'], list):
             filtered_content = [
                 content for content in message['content']
@@ -794,46 +3755,33 @@ async def chat_with_ollama(user_input, image_path=None, current_iteration=None,
 
     # Combine filtered history with current conversation to maintain context
     messages = filtered_conversation_history + current_conversation
+    save_state(messages)
 
     try:
         # MAINMODEL call, which maintains context
         # Prepend the system message to the messages list
-        system_message = {"role": "system", "content": update_system_prompt(current_iteration, max_iterations)}
+        system_message = {"role": "system", "content": update_system_prompt(current_iteration, max_iterations, clear_notes=label is None)}
         messages_with_system = [system_message] + messages
         
-        response = await client.chat(
-            model=MAINMODEL,
-            messages=messages_with_system,
-            tools=tools,
-            stream=False
-        )
-        
-        # Check if the response is a dictionary
-        if isinstance(response, dict):
-            if 'error' in response:
-                console.print(Panel(f"Error: {response['error']}", title="API Error", style="bold red"))
-                return f"I'm sorry, but there was an error with the model response: {response['error']}", False
-            elif 'message' in response:
-                assistant_message = response['message']
-                assistant_response = assistant_message.get('content', '')
-                exit_continuation = CONTINUATION_EXIT_PHRASE in assistant_response
-                tool_calls = assistant_message.get('tool_calls', [])
-            else:
-                # Handle unexpected dictionary response
-                console.print(Panel("Unexpected response format", title="API Error", style="bold red"))
-                return "I'm sorry, but there was an unexpected error in the model response.", False
+        if stream:
+            response = await stream_model_chat("main", messages_with_system, "Ollama's Response")
         else:
-            # Handle unexpected non-dictionary response
-            console.print(Panel("Unexpected response type", title="API Error", style="bold red"))
-            return "I'm sorry, but there was an unexpected error in the model response.", False
+            response = await call_model("main", messages_with_system, tools)
+        assistant_response = response["content"]
+        tool_calls = response["tool_calls"]
+        exit_continuation = CONTINUATION_EXIT_PHRASE in assistant_response
+        if defer_goals and tool_calls and not exit_continuation and len(parse_goals(assistant_response)) > 1:
+            console.print(Panel(f"Leaving {len(tool_calls)} tool calls to the goal agents.", title="Tool Usage", style="yellow"))
+            tool_calls = []
     except Exception as e:
-        console.print(Panel(f"API Error: {str(e)}", title="API Error", style="bold red"))
-        return "I'm sorry, there was an error communicating with the AI. Please try again.", False
+        console.print(Panel(f"API Error: {str(e)}", title=f"{prefix}API Error", style="bold red"))
+        return "I'm sorry, there was an error communicating with the AI. Please try again.", False, None, current_conversation
 
-    console.print(Panel(Markdown(assistant_response), title="Ollama's Response", title_align="left", border_style="blue", expand=False))
+    if not stream:
+        console.print(Panel(Markdown(assistant_response), title=f"{prefix}Ollama's Response", title_align="left", border_style="blue", expand=False))
 
     if tool_calls:
-        console.print(Panel("Tool calls detected", title="Tool Usage", style="bold yellow"))
+        console.print(Panel("Tool calls detected", title=f"{prefix}Tool Usage", style="bold yellow"))
         console.print(Panel(json.dumps(tool_calls, indent=2), title="Tool Calls", style="cyan"))
 
     # Display files in context
@@ -843,171 +3791,313 @@ async def chat_with_ollama(user_input, image_path=None, current_iteration=None,
         files_in_context = "No files in context. Read, create, or edit files to add."
     console.print(Panel(files_in_context, title="Files in Context", title_align="left", border_style="white", expand=False))
 
-    for tool_call in tool_calls:
-        tool_name = tool_call['function']['name']
-        tool_arguments = tool_call['function']['arguments']
-        
-        # Check if tool_arguments is a string and parse it if necessary
-        if isinstance(tool_arguments, str):
-            try:
-                tool_input = json.loads(tool_arguments)
-            except json.JSONDecodeError:
-                tool_input = {"error": "Failed to parse tool arguments"}
-        else:
-            tool_input = tool_arguments
-
-        console.print(Panel(f"Tool Used: {tool_name}", style="green"))
-        console.print(Panel(f"Tool Input: {json.dumps(tool_input, indent=2)}", style="green"))
+    if tool_calls:
+        for tool_call in tool_calls:
+            console.print(Panel(f"{prefix}Tool Used: {tool_call['function']['name']}", style="green"))
+            console.print(Panel(f"Tool Input: {json.dumps(get_tool_input(tool_call), indent=2)}", style="green"))
 
-        tool_result = await execute_tool(tool_call)
-        
-        if tool_result["is_error"]:
-            console.print(Panel(tool_result["content"], title="Tool Execution Error", style="bold red"))
-        else:
-            console.print(Panel(tool_result["content"], title_align="left", title="Tool Result", style="green"))
+        tool_results = await execute_tool_calls(tool_calls)
 
         current_conversation.append({
             "role": "assistant",
             "content": None,
-            "tool_calls": [tool_call]
+            "tool_calls": tool_calls
         })
 
-        current_conversation.append({
-            "role": "tool",
-            "content": tool_result["content"],
-            "tool_call_id": tool_call.get('id', 'unknown_id')  # Use 'unknown_id' if 'id' is not present
-        })
+        for tool_call, tool_result in zip(tool_calls, tool_results):
+            if tool_result["is_error"]:
+                console.print(Panel(tool_result["content"], title=f"{prefix}Tool Execution Error: {tool_call['function']['name']}", style="bold red"))
+            else:
+                console.print(Panel(tool_result["content"], title_align="left", title=f"{prefix}Tool Result: {tool_call['function']['name']}", style="green"))
 
-        # Update the file_contents dictionary if applicable
-        if tool_name in ['create_file', 'edit_and_apply', 'read_file'] and not tool_result["is_error"]:
-            if 'path' in tool_input:
-                file_path = tool_input['path']
-                if "File contents updated in system prompt" in tool_result["content"] or \
-                   "File created and added to system prompt" in tool_result["content"] or \
-                   "has been read and stored in the system prompt" in tool_result["content"]:
-                    # The file_contents dictionary is already updated in the tool function
-                    pass
+            current_conversation.append({
+                "role": "tool",
+                "content": tool_result["content"],
+                "tool_call_id": tool_call.get('id', 'unknown_id')  # Use 'unknown_id' if 'id' is not present
+            })
 
         messages = filtered_conversation_history + current_conversation
+        save_state(messages)
 
+        # A single TOOLCHECKERMODEL call reviews every result from this turn
         try:
             # Prepend the system message to the messages list
-            system_message = {"role": "system", "content": update_system_prompt(current_iteration, max_iterations)}
+            system_message = {"role": "system", "content": update_system_prompt(current_iteration, max_iterations, clear_notes=label is None)}
             messages_with_system = [system_message] + messages
             
-            tool_response = await client.chat(
-                model=TOOLCHECKERMODEL,
-                messages=messages_with_system,
-                tools=tools,
-                stream=False
-            )
-
-            if isinstance(tool_response, dict) and 'message' in tool_response:
-                tool_checker_response = tool_response['message'].get('content', '')
-                console.print(Panel(Markdown(tool_checker_response), title="Ollama's Response to Tool Result",  title_align="left", border_style="blue", expand=False))
-                assistant_response += "\n\n" + tool_checker_response
+            if stream:
+                tool_response = await stream_model_chat("tool_checker", messages_with_system, "Ollama's Response to Tool Results")
             else:
-                error_message = "Unexpected tool response format"
-                console.print(Panel(error_message, title="Error", style="bold red"))
-                assistant_response += f"\n\n{error_message}"
+                tool_response = await call_model("tool_checker", messages_with_system, tools)
+                console.print(Panel(Markdown(tool_response["content"]), title=f"{prefix}Ollama's Response to Tool Results",  title_align="left", border_style="blue", expand=False))
+            assistant_response += "\n\n" + tool_response["content"]
         except Exception as e:
             error_message = f"Error in tool response: {str(e)}"
-            console.print(Panel(error_message, title="Error", style="bold red"))
+            console.print(Panel(error_message, title=f"{prefix}Error", style="bold red"))
             assistant_response += f"\n\n{error_message}"
 
     if assistant_response:
         current_conversation.append({"role": "assistant", "content": assistant_response})
 
-    conversation_history = messages + [{"role": "assistant", "content": assistant_response}]
-
-    return assistant_response, exit_continuation
+    return assistant_response, exit_continuation, messages, current_conversation
 
 def reset_code_editor_memory():
-    global code_editor_memory
-    code_editor_memory = []
+    code_editor_memory.clear()
     console.print(Panel("Code editor memory has been reset.", title="Reset", style="bold green"))
 
 
-def reset_conversation():
-    global conversation_history, file_contents, code_editor_files
+class AutomodeProgressMonitor:
+    # Fingerprints every automode iteration: the files in context (path and hash), the tool calls
+    # and the response. An iteration made progress if a file changed, if it made tool calls it
+    # hadn't made before, or, without tool calls, if its response isn't a near repeat of a recent
+    # one. After AUTOMODE_STALL_ITERATIONS iterations in a row without progress the run is
+    # redirected, and stopped if that doesn't help either.
+    def __init__(self, run):
+        self.run = run
+        self.seen_tool_calls = set()
+        self.recent_responses = deque(maxlen=AUTOMODE_STALL_ITERATIONS)
+        self.files = self.file_fingerprint()
+        self.stalled = 0
+        self.redirected = False
+        self.iterations = 0
+        self.started = time.time()
+        self.tokens_at_start = self.total_tokens()
+
+    @staticmethod
+    def file_fingerprint():
+        return {path: stats[2] for path, stats in list(file_contents.file_stats.items())}
+
+    @staticmethod
+    def total_tokens():
+        return sum(totals["input_tokens"] + totals["output_tokens"] for totals in role_token_totals.values())
+
+    def is_repeat(self, response):
+        response = response[:AUTOMODE_SIMILARITY_CHARS]
+        for previous in self.recent_responses:
+            matcher = difflib.SequenceMatcher(None, previous, response, autojunk=False)
+            if matcher.real_quick_ratio() >= AUTOMODE_SIMILARITY_THRESHOLD and matcher.quick_ratio() >= AUTOMODE_SIMILARITY_THRESHOLD and matcher.ratio() >= AUTOMODE_SIMILARITY_THRESHOLD:
+                return True
+        return False
+
+    def observe(self, new_messages, response):
+        # Returns "continue", "redirect" or "stop" for the iteration that added new_messages
+        self.iterations += 1
+        files = self.file_fingerprint()
+        files_changed = files != self.files
+        self.files = files
+        tool_calls = frozenset(
+            AutomodeRun.tool_key(tool_call['function']['name'], get_tool_input(tool_call))
+            for message in new_messages if message.get("role") == "assistant"
+            for tool_call in message.get("tool_calls") or []
+        )
+        if files_changed:
+            progress = True
+        elif tool_calls:
+            progress = not tool_calls <= self.seen_tool_calls
+        else:
+            progress = not self.is_repeat(response)
+        self.seen_tool_calls |= tool_calls
+        self.recent_responses.append(response[:AUTOMODE_SIMILARITY_CHARS])
+
+        if progress:
+            self.stalled = 0
+            self.redirected = False
+            return "continue"
+        self.stalled += 1
+        if self.stalled < AUTOMODE_STALL_ITERATIONS:
+            return "continue"
+        if not self.redirected:
+            self.redirected = True
+            self.stalled = 0
+            return "redirect"
+        return "stop"
+
+    def savings(self):
+        # Estimated from the average iteration so far, for the iterations left that won't run
+        remaining = self.run.max_iterations - self.run.iteration
+        if not self.iterations or remaining <= 0:
+            return 0, 0, 0.0
+        tokens = (self.total_tokens() - self.tokens_at_start) * remaining // self.iterations
+        seconds = (time.time() - self.started) * remaining / self.iterations
+        return remaining, tokens, seconds
+
+
+async def run_automode(run):
+    # Runs the automode loop from the run's saved iteration, checkpointing it after each one. A run
+    # interrupted mid-iteration keeps its last checkpoint and resumes from the start of that iteration.
+    global automode, automode_run
+    automode = True
+    automode_run = run
+    user_input = run.next_input
+    monitor = AutomodeProgressMonitor(run)
+    save_automode_checkpoint(run)
+    try:
+        while automode and run.iteration < run.max_iterations:
+            history_before = list(conversation_history)
+            # The goals set by the first response run as concurrent agents where they don't depend on each
+            # other, in place of that response's own tool calls
+            concurrent_goals = AUTOMODE_CONCURRENT_GOALS and not run.goals
+            response, exit_continuation = await chat_with_ollama(user_input, current_iteration=run.iteration+1, max_iterations=run.max_iterations, defer_goals=concurrent_goals)
+            goals = parse_goals(response)
+            if concurrent_goals and len(goals) > 1 and not exit_continuation and CONTINUATION_EXIT_PHRASE not in response:
+                exit_continuation = await execute_goals(goals)
+            run.goals = goals or run.goals
+
+            if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
+                console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
+                automode = False
+                run.status = "completed"
+            else:
+                console.print(Panel(f"Continuation iteration {run.iteration + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
+                user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."
+                before = {id(message) for message in history_before}
+                verdict = monitor.observe([message for message in conversation_history if id(message) not in before], response)
+                if verdict == "redirect":
+                    console.print(Panel(f"No progress in the last {AUTOMODE_STALL_ITERATIONS} iterations, asking the model to change approach.", title_align="left", title="Automode", style="bold yellow"))
+                    user_input = AUTOMODE_REDIRECT_PROMPT
+                elif verdict == "stop":
+                    automode = False
+                    run.status = "stalled"
+            run.iteration += 1
+            run.next_input = user_input
+
+            if run.status == "stalled":
+                remaining, tokens, seconds = monitor.savings()
+                console.print(Panel(
+                    f"Still no progress {AUTOMODE_STALL_ITERATIONS} iterations after a redirect. Exiting automode, "
+                    f"skipping {remaining} remaining iterations (about {tokens} tokens and {seconds:.0f}s at the average so far).",
+                    title_align="left", title="Automode", style="bold red"))
+
+            if run.iteration >= run.max_iterations:
+                console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
+                automode = False
+                if run.status == "running":
+                    run.status = "max_iterations"
+            save_automode_checkpoint(run)
+    except KeyboardInterrupt:
+        console.print(Panel(f"\nAutomode interrupted by user. Exiting automode. Type 'automode resume {run.run_id}' to continue it.", title_align="left", title="Automode", style="bold red"))
+        automode = False
+        if conversation_history and conversation_history[-1]["role"] == "user":
+            conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})
+    finally:
+        automode_run = None
+
+
+def reset_conversation(quiet=False):
+    global conversation_history, conversation_tokens, code_editor_files, session_store
     conversation_history = []
-    file_contents = {}
+    conversation_tokens = 0
+    file_contents.clear()
+    file_change_notes.clear()
+    unreported_file_changes.clear()
+    partial_file_views.clear()
+    file_prompt_segments.clear()
     code_editor_files = set()
+    if quiet:
+        code_editor_memory.clear()
+        return
     reset_code_editor_memory()
+    # The conversation starts over in a new session log, the old one can still be resumed
+    if session_store is not None:
+        session_store.close()
+        session_store = SessionStore()
     console.print(Panel("Conversation history, file contents, code editor memory, and code editor files have been reset.", title="Reset", style="bold green"))
 
 
 
 
 async def main():
-    global automode, conversation_history
+    global automode, conversation_history, session_store, automode_chat_log
     console.print(Panel("Welcome to the Ollama Llama 3.1 Engineer Chat with Multi-Agent and Image Support!", title="Welcome", style="bold green"))
     console.print("Type 'exit' to end the conversation.")
     console.print("Type 'automode [number]' to enter Autonomous mode with a specific number of iterations.")
+    console.print("Type 'automode resume [run id]' to continue an interrupted automode run (the latest one by default).")
     console.print("Type 'reset' to clear the conversation history.")
-    console.print("Type 'save chat' to save the conversation to a Markdown file.")
+    console.print("Type 'save chat' to save the conversation to a Markdown file ('save chat json' for JSON Lines).")
+    console.print("Type 'resume [session id]' to continue a saved session (the latest one by default).")
     console.print("While in automode, press Ctrl+C at any time to exit the automode to return to regular chat.")
 
-    while True:
-        user_input = await get_user_input()
+    session_store = SessionStore()
+    console.print(f"Session {session_store.session_id} is saved to {SESSION_DIR} as you go. Type 'resume <id>' in a later run to continue it.")
 
-        if user_input.lower() == 'exit':
-            console.print(Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green"))
-            break
+    watcher = start_file_watcher()
+    if watcher is not None:
+        console.print(f"Watching {watcher.root} for changes to files in context ({watcher.mode}).")
+    start_code_index()
 
-        if user_input.lower() == 'reset':
-            reset_conversation()
-            continue
+    try:
+        while True:
+            user_input = await get_user_input()
 
-        if user_input.lower() == 'save chat':
-            filename = save_chat()
-            console.print(Panel(f"Chat saved to {filename}", title="Chat Saved", style="bold green"))
-            continue
+            if user_input.lower() == 'exit':
+                console.print(Panel("Thank you for chatting. Goodbye!", title_align="left", title="Goodbye", style="bold green"))
+                display_token_usage()
+                break
 
+            if user_input.lower() == 'reset':
+                reset_conversation()
+                continue
 
-        if user_input.lower().startswith('automode'):
-            try:
+            if user_input.lower().split()[:1] == ['resume']:
                 parts = user_input.split()
-                if len(parts) > 1 and parts[1].isdigit():
-                    max_iterations = int(parts[1])
-                else:
-                    max_iterations = MAX_CONTINUATION_ITERATIONS
+                try:
+                    result = resume_session(parts[1] if len(parts) > 1 else None)
+                    console.print(Panel(result, title="Resume", style="bold green"))
+                except Exception as e:
+                    console.print(Panel(f"Error resuming session: {str(e)}", title="Resume", style="bold red"))
+                continue
 
-                automode = True
-                console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
-                console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))
-                user_input = await get_user_input()
+            if user_input.lower() in ('save chat', 'save chat md', 'save chat json'):
+                filename = save_chat(user_input.split()[2].lower() if len(user_input.split()) > 2 else "md")
+                console.print(Panel(f"Chat saved to {filename}", title="Chat Saved", style="bold green"))
+                continue
 
-                iteration_count = 0
-                try:
-                    while automode and iteration_count < max_iterations:
-                        response, exit_continuation = await chat_with_ollama(user_input, current_iteration=iteration_count+1, max_iterations=max_iterations)
 
-                        if exit_continuation or CONTINUATION_EXIT_PHRASE in response:
-                            console.print(Panel("Automode completed.", title_align="left", title="Automode", style="green"))
-                            automode = False
+            if user_input.lower().startswith('automode'):
+                run = None
+                try:
+                    parts = user_input.split()
+                    if len(parts) > 1 and parts[1].lower() == 'resume':
+                        run, result = resume_automode(parts[2] if len(parts) > 2 else None)
+                        console.print(Panel(result, title_align="left", title="Automode", style="bold yellow" if run else "bold red"))
+                        if run is None:
+                            continue
+                    else:
+                        if len(parts) > 1 and parts[1].isdigit():
+                            max_iterations = int(parts[1])
                         else:
-                            console.print(Panel(f"Continuation iteration {iteration_count + 1} completed. Press Ctrl+C to exit automode. ", title_align="left", title="Automode", style="yellow"))
-                            user_input = "Continue with the next step. Or STOP by saying 'AUTOMODE_COMPLETE' if you think you've achieved the results established in the original request."
-                        iteration_count += 1
+                            max_iterations = MAX_CONTINUATION_ITERATIONS
 
-                        if iteration_count >= max_iterations:
-                            console.print(Panel("Max iterations reached. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                            automode = False
+                        automode = True
+                        console.print(Panel(f"Entering automode with {max_iterations} iterations. Please provide the goal of the automode.", title_align="left", title="Automode", style="bold yellow"))
+                        user_input = await get_user_input()
+                        run = AutomodeRun(user_input, max_iterations)
+                    console.print(Panel("Press Ctrl+C at any time to exit the automode loop.", style="bold yellow"))
+                    console.print(f"Checkpointing this run to {run.path}, type 'automode resume {run.run_id}' to continue it if it's interrupted.", style="dim")
+
+                    if AUTOMODE_CHAT_LOG_FORMAT:
+                        automode_chat_log = ChatLog(AUTOMODE_CHAT_LOG_FORMAT, prefix="Automode")
+                        console.print(f"Logging this automode run to {automode_chat_log.filename}", style="dim")
+
+                    await run_automode(run)
                 except KeyboardInterrupt:
                     console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
                     automode = False
                     if conversation_history and conversation_history[-1]["role"] == "user":
                         conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})
-            except KeyboardInterrupt:
-                console.print(Panel("\nAutomode interrupted by user. Exiting automode.", title_align="left", title="Automode", style="bold red"))
-                automode = False
-                if conversation_history and conversation_history[-1]["role"] == "user":
-                    conversation_history.append({"role": "assistant", "content": "Automode interrupted. How can I assist you further?"})
 
-            console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
-        else:
-            response, _ = await chat_with_ollama(user_input)
+                if automode_chat_log is not None:
+                    automode_chat_log.close()
+                    automode_chat_log = None
+                console.print(Panel("Exited automode. Returning to regular chat.", style="green"))
+            else:
+                response, _ = await chat_with_ollama(user_input)
+    finally:
+        # Also runs on EOF and Ctrl+C, not only on 'exit'
+        await close_search_session()
+        await close_providers()
+        stop_file_watcher()
+        session_store.close()
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,18 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.fixture(scope="session")
+def engineer():
+    # ollama-eng.py isn't importable by name because of the dash in it
+    os.environ.setdefault("TAVILY_API_KEY", "test")
+    spec = importlib.util.spec_from_file_location("ollama_eng", os.path.join(ROOT, "ollama-eng.py"))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules["ollama_eng"] = module
+    spec.loader.exec_module(module)
+    return module
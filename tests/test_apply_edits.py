@@ -0,0 +1,52 @@
+import asyncio
+
+
+def apply(engineer, tmp_path, content, edits):
+    path = tmp_path / "module.py"
+    path.write_text(content)
+    return asyncio.run(engineer.apply_edits(str(path), edits, content))
+
+
+def test_mismatched_indentation_is_reindented_like_the_file(engineer, tmp_path):
+    content = "def f():\n    x = 1\n    y = 2\n"
+    edits = [{"search": "x = 1\ny = 2", "replace": "x = 5\ny = 6"}]
+
+    edited, changes_made, failed = apply(engineer, tmp_path, content, edits)
+
+    assert changes_made and not failed
+    assert edited == "def f():\n    x = 5\n    y = 6\n"
+    assert (tmp_path / "module.py").read_text() == edited
+
+
+def test_nested_replace_lines_keep_their_relative_indentation(engineer, tmp_path):
+    content = "class A:\n    def f(self):\n        return 1\n"
+    edits = [{"search": "def f(self):\n    return 1", "replace": "def f(self):\n    if self:\n        return 2\n    return 1"}]
+
+    edited, _, failed = apply(engineer, tmp_path, content, edits)
+
+    assert not failed
+    assert edited == "class A:\n    def f(self):\n        if self:\n            return 2\n        return 1\n"
+
+
+def test_inconsistent_indentation_is_rejected(engineer, tmp_path):
+    content = "def f():\n    x = 1\n    y = 2\n"
+    edits = [{"search": "    x = 1\ny = 2", "replace": "    x = 5\ny = 6"}]
+
+    edited, changes_made, failed = apply(engineer, tmp_path, content, edits)
+
+    assert not changes_made
+    assert edited == content
+    assert "indentation" in failed
+
+
+def test_block_can_match_text_inserted_by_an_earlier_block(engineer, tmp_path):
+    content = "a = 1\n"
+    edits = [
+        {"search": "a = 1", "replace": "a = 1\nb = 2"},
+        {"search": "b = 2", "replace": "b = 3"},
+    ]
+
+    edited, _, failed = apply(engineer, tmp_path, content, edits)
+
+    assert not failed
+    assert edited == "a = 1\nb = 3\n"
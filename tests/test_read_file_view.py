@@ -0,0 +1,65 @@
+import asyncio
+
+
+def test_single_line_file_view_is_bounded(engineer, tmp_path):
+    path = tmp_path / "huge.json"
+    path.write_text("[" + "1234567," * 1_000_000 + "0]")
+
+    view = engineer.read_file_view(str(path))
+
+    assert len(view) < engineer.MAX_VIEW_CHARS + 1000
+    assert "line cut" in view
+
+
+def test_open_ended_range_is_bounded(engineer, tmp_path):
+    path = tmp_path / "huge.log"
+    path.write_text("short line\n" + "x" * 5_000_000 + "\n" + "line\n" * 100_000)
+
+    text = engineer.read_line_range(str(path), 1)
+
+    assert text.startswith("short line\n")
+    assert len(text) < engineer.MAX_VIEW_CHARS + 1000
+    assert "truncated" in text
+
+
+def test_small_range_is_unchanged(engineer, tmp_path):
+    path = tmp_path / "small.py"
+    path.write_text("".join(f"line {i}\n" for i in range(1, 11)))
+
+    assert engineer.read_line_range(str(path), 3, 4) == "line 3\nline 4\n"
+
+
+def test_large_file_is_stored_as_bounded_view(engineer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    path = tmp_path / "huge.txt"
+    path.write_text("y" * 7_000_000)
+
+    engineer.load_file_into_context("huge.txt")
+
+    assert "huge.txt" in engineer.partial_file_views
+    assert len(engineer.file_contents["huge.txt"]) < engineer.MAX_VIEW_CHARS + 1000
+
+
+def test_non_utf8_text_is_not_treated_as_binary(engineer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "latin1.py").write_bytes("name = 'café'\n".encode("latin-1"))
+    (tmp_path / "utf16.py").write_text("name = 'café'\n", encoding="utf-16")
+    (tmp_path / "data.bin").write_bytes(bytes(range(256)) * 4)
+
+    engineer.load_file_into_context("latin1.py")
+    engineer.load_file_into_context("utf16.py")
+
+    assert engineer.file_contents["latin1.py"].startswith("name = 'caf")
+    assert engineer.file_contents["utf16.py"] == "name = 'café'\n"
+    assert "binary" in engineer.load_file_into_context("data.bin")
+
+
+def test_bounded_view_is_not_sent_whole_to_the_editor(engineer, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "huge.py").write_text("x = 1\n" * 2_000_000)
+    engineer.load_file_into_context("huge.py")
+
+    result = asyncio.run(engineer.edit_and_apply("huge.py", "rename x", ""))
+
+    assert result.startswith("Error editing/applying to file")
+    assert "symbol" in result